@@ -0,0 +1,206 @@
+# -*- coding: utf-8 -*-
+
+""" bench_peewee_eve_sync.py - Benchmark the peewee_eve_sync push and pull.
+
+N clients, each with its own SQLite database, sync M models of K records
+through an in-process Eve stand-in (see peewee_eve_sync.local_api).
+
+Usage: python bench_peewee_eve_sync.py --clients 3 --models 2 --records 500 --latency 0.005
+
+"""
+
+import argparse
+import json
+import resource
+import time
+import uuid
+import peewee
+from peewee_eve_sync import model as sync_model
+from peewee_eve_sync.model import History, KeyValue, ETag, SeenHistory, Lease, SyncedModel, SyncSettings
+from peewee_eve_sync.local_api import LocalApi
+from peewee_eve_sync.transport import LocalTransport, CircuitBreaker
+from peewee_eve_sync.engine import SyncEngine
+import logging
+
+log = logging.getLogger()
+log.addHandler(logging.StreamHandler())
+log.setLevel(logging.CRITICAL)
+
+
+class CountingDatabase(peewee.SqliteDatabase):
+    """ SqliteDatabase counting the executed SQL statements. """
+    def __init__(self, *args, **kwargs):
+        super(CountingDatabase, self).__init__(*args, **kwargs)
+        self.queries = 0
+
+    def execute_sql(self, sql, params=None, require_commit=True):
+        self.queries += 1
+        return super(CountingDatabase, self).execute_sql(sql, params, require_commit)
+
+
+def make_models(count, transport, batch_size, page_size, bootstrap):
+    """ Create count SyncedModel subclasses. """
+    models = []
+    for i in range(count):
+        class Sync(SyncSettings):
+            pass
+        Sync.transport = transport
+        Sync.batch_size = batch_size
+        Sync.page_size = page_size
+        Sync.bootstrap = bootstrap
+        models.append(type("BenchModel{0}".format(i), (SyncedModel,),
+                           {"uuid": peewee.CharField(),
+                            "name": peewee.CharField(),
+                            "value": peewee.IntegerField(),
+                            "Sync": Sync,
+                            "__module__": __name__}))
+    return models
+
+
+class Client(object):
+    """ A sync client, with its own in-memory database. """
+    def __init__(self, name, models, concurrency):
+        self.name = name
+        self.models = models
+        self.database = CountingDatabase(":memory:", threadlocals=False, check_same_thread=False)
+        self.engine = SyncEngine(models, concurrency)
+        self.activate()
+        for m in [History, KeyValue, ETag, SeenHistory, Lease] + models:
+            m.create_table()
+
+    def activate(self):
+        """ Bind all the models to the client database. """
+        for m in [History, KeyValue, ETag, SeenHistory, Lease] + self.models:
+            m._meta.database = self.database
+
+    def snapshot(self):
+        self.activate()
+        return dict((m._meta.name, sorted((r.uuid, r.name, r.value) for r in m._select()))
+                    for m in self.models)
+
+
+class Bench(object):
+    def __init__(self, clients=3, models=2, records=200, latency=0, batch_size=50,
+                 page_size=100, concurrency=1, conflicts=10, body_encoding="form", compress=False,
+                 bootstrap=False):
+        self.records = records
+        self.conflicts = conflicts
+        self.concurrency = concurrency
+        self.api = LocalApi(latency=latency)
+        transport = LocalTransport(self.api, breaker=CircuitBreaker(threshold=1000),
+                                   body_encoding=body_encoding, compress=compress)
+        self.models = make_models(models, transport, batch_size, page_size, bootstrap)
+        self.clients = [Client("client{0}".format(i), self.models, concurrency) for i in range(clients)]
+        self.owned = dict((c.name, dict((m, []) for m in self.models)) for c in self.clients)
+        self.results = []
+
+    def phase(self, name, write=None):
+        """ Perform local writes on each client, then sync all the clients and record the stats. """
+        for client in self.clients:
+            client.activate()
+            if write is not None:
+                write(client)
+        self.api.reset_stats()
+        queries = sum(c.database.queries for c in self.clients)
+        start = time.time()
+        pushed = pulled = errors = 0
+        for client in self.clients:
+            client.activate()
+            stats = client.engine.sync()
+            pushed += stats.pushed
+            pulled += stats.pulled
+            errors += len(stats.errors)
+        elapsed = time.time() - start
+        self.results.append({"phase": name,
+                             "elapsed": elapsed,
+                             "round_trips": self.api.round_trips,
+                             "calls": dict(self.api.stats["calls"]),
+                             "conflicts": self.api.stats["status"].get(412, 0),
+                             "bytes_sent": self.api.stats["bytes_sent"],
+                             "bytes_received": self.api.stats["bytes_received"],
+                             "sql": sum(c.database.queries for c in self.clients) - queries,
+                             "pushed": pushed,
+                             "pulled": pulled,
+                             "errors": errors,
+                             "throughput": (pushed + pulled) / elapsed if elapsed else 0.0,
+                             # ru_maxrss is the peak of the whole process, in KB on Linux
+                             "peak_memory": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss})
+
+    def create(self, client):
+        for m in self.models:
+            rows = [{"uuid": uuid.uuid4().hex, "name": "{0}-{1}".format(client.name, i), "value": i}
+                    for i in range(self.records)]
+            m.insert_many(rows).execute()
+            self.owned[client.name][m] = [row["uuid"] for row in rows]
+
+    def update(self, client):
+        for m in self.models:
+            pks = self.owned[client.name][m][:self.records / 2]
+            m.update(value=m.value + 1).where(m.uuid << pks).execute()
+            # Every client updates the same records of the first client
+            shared = self.owned[self.clients[0].name][m][:self.conflicts]
+            for record in m._select().where(m.uuid << shared):
+                record.name = client.name
+                record.save()
+
+    def delete(self, client):
+        for m in self.models:
+            pks = self.owned[client.name][m][-self.records / 4:]
+            m.delete().where(m.uuid << pks).execute()
+
+    def run(self):
+        self.phase("create", self.create)
+        self.phase("update", self.update)
+        self.phase("delete", self.delete)
+        self.phase("converge")
+        # A new client joins once the others converged
+        self.clients.append(Client("client{0}".format(len(self.clients)), self.models, self.concurrency))
+        self.phase("join")
+        snapshots = [c.snapshot() for c in self.clients]
+        self.converged = all(s == snapshots[0] for s in snapshots)
+        return self.results
+
+    def report(self):
+        columns = ("phase", "elapsed", "round_trips", "conflicts", "bytes_received", "bytes_sent",
+                   "sql", "pushed", "pulled", "errors", "throughput", "peak_memory")
+        lines = ["  ".join("{0:>12}".format(c) for c in columns)]
+        for result in self.results:
+            lines.append("  ".join("{0:>12.3f}".format(result[c]) if isinstance(result[c], float)
+                                   else "{0:>12}".format(result[c]) for c in columns))
+        lines.append("converged: {0}".format(self.converged))
+        return "\n".join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--clients", type=int, default=3, help="number of clients (N)")
+    parser.add_argument("--models", type=int, default=2, help="number of models (M)")
+    parser.add_argument("--records", type=int, default=200, help="records created per client and model (K)")
+    parser.add_argument("--latency", type=float, default=0, help="seconds added to each API call")
+    parser.add_argument("--batch-size", type=int, default=50, help="Sync.batch_size")
+    parser.add_argument("--page-size", type=int, default=100, help="Sync.page_size")
+    parser.add_argument("--concurrency", type=int, default=1, help="models synced at the same time per client")
+    parser.add_argument("--conflicts", type=int, default=10, help="records updated by every client")
+    parser.add_argument("--body-encoding", default="form", choices=["form", "json", "msgpack"],
+                        help="encoding of the request bodies")
+    parser.add_argument("--compress", action="store_true", help="gzip the request bodies")
+    parser.add_argument("--bootstrap", action="store_true",
+                        help="the joining client downloads a snapshot instead of replaying the History")
+    parser.add_argument("--json", action="store_true", help="output the results as JSON")
+    args = parser.parse_args()
+
+    # Conflicting updates are retried right away, instead of after a backoff
+    sync_model.RETRY_DELAY = 0
+    bench = Bench(args.clients, args.models, args.records, args.latency, args.batch_size,
+                  args.page_size, args.concurrency, args.conflicts, args.body_encoding, args.compress,
+                  args.bootstrap)
+    bench.run()
+    if args.json:
+        print json.dumps({"args": vars(args), "results": bench.results, "converged": bench.converged},
+                         indent=2)
+    else:
+        print bench.report()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,42 @@
+# encoding: utf-8
+import hashlib
+import math
+import struct
+
+
+class BloomFilter(object):
+    """ Set membership test without false negatives, with a bounded rate of false positives.
+
+    :type capacity: int
+    :param capacity: Number of items the false positive rate is guaranteed for.
+
+    :type error_rate: float
+    :param error_rate: False positive rate once capacity items are added.
+
+    """
+    def __init__(self, capacity=100000, error_rate=0.001):
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.size = int(math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = max(1, int(round(self.size / float(capacity) * math.log(2))))
+        self.bits = bytearray((self.size + 7) / 8)
+        self.count = 0
+
+    def _positions(self, key):
+        if isinstance(key, unicode):
+            key = key.encode("utf-8")
+        # Double hashing: the k positions are derived from two 64 bits hashes
+        h1, h2 = struct.unpack("<QQ", hashlib.md5(key).digest())
+        return [(h1 + i * h2) % self.size for i in range(self.hashes)]
+
+    def add(self, key):
+        for pos in self._positions(key):
+            self.bits[pos >> 3] |= 1 << (pos & 7)
+        self.count += 1
+
+    def __contains__(self, key):
+        return all(self.bits[pos >> 3] & (1 << (pos & 7)) for pos in self._positions(key))
+
+    @property
+    def is_full(self):
+        return self.count >= self.capacity
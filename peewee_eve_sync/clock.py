@@ -0,0 +1,38 @@
+# encoding: utf-8
+from datetime import datetime
+import threading
+
+
+def get_ts():
+    return int(datetime.utcnow().strftime("%s"))
+
+
+class HybridClock(object):
+    """ Hybrid logical clock, timestamping History entries with (ts, seq).
+
+    ts is the wall clock in seconds, but never goes back, and seq orders
+    the entries sharing the same ts. The clock also moves past the remote
+    History entries received, so the entries created afterwards are always
+    ordered after them, even if the wall clock of this client is late.
+
+    """
+    def __init__(self, wall=get_ts):
+        self.wall = wall
+        self.last = (0, 0)
+        self.lock = threading.Lock()
+
+    def now(self):
+        """ Return a new (ts, seq), greater than all the previous ones. """
+        with self.lock:
+            ts, seq = self.last
+            wall = self.wall()
+            self.last = (wall, 0) if wall > ts else (ts, seq + 1)
+            return self.last
+
+    def update(self, ts, seq=0):
+        """ Move the clock past a received (ts, seq). """
+        with self.lock:
+            self.last = max(self.last, (ts, seq))
+
+
+clock = HybridClock()
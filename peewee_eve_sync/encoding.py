@@ -0,0 +1,69 @@
+# encoding: utf-8
+""" Serialization of the payloads exchanged with the API.
+
+The fastest available JSON backend is used (ujson, simplejson, then json),
+and msgpack is supported if installed.
+
+"""
+import gzip
+import json
+from StringIO import StringIO
+
+try:
+    import ujson as json_backend
+except ImportError:
+    try:
+        import simplejson as json_backend
+    except ImportError:
+        json_backend = json
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+JSON = "application/json"
+MSGPACK = "application/x-msgpack"
+
+
+def dumps(obj):
+    return json_backend.dumps(obj)
+
+
+def loads(data):
+    return json_backend.loads(data)
+
+
+def pack(obj, content_type=JSON):
+    """ Encode an object as JSON or msgpack. """
+    if content_type == MSGPACK:
+        return msgpack.packb(obj, use_bin_type=True)
+    return dumps(obj)
+
+
+def unpack(data, content_type=JSON):
+    """ Decode a JSON or msgpack body, an empty body is decoded as {}. """
+    if not data:
+        return {}
+    if content_type.split(";")[0].strip() == MSGPACK:
+        return msgpack.unpackb(data, raw=False)
+    return loads(data)
+
+
+def document(data):
+    """ Resources and History data may be stored as a JSON string by older versions. """
+    if isinstance(data, basestring):
+        return loads(data)
+    return data
+
+
+def compress(data):
+    out = StringIO()
+    f = gzip.GzipFile(fileobj=out, mode="wb")
+    f.write(data)
+    f.close()
+    return out.getvalue()
+
+
+def decompress(data):
+    return gzip.GzipFile(fileobj=StringIO(data)).read()
@@ -0,0 +1,142 @@
+# encoding: utf-8
+from multiprocessing.pool import ThreadPool
+import logging
+import time
+
+from model import SyncedModel
+from transport import CircuitOpen
+
+log = logging.getLogger(__name__)
+
+
+def synced_models(base=SyncedModel):
+    """ Return all the subclasses of a SyncedModel. """
+    models = []
+    for model in base.__subclasses__():
+        models.append(model)
+        models.extend(synced_models(model))
+    return models
+
+
+class ModelStats(object):
+    """ Result of the sync of a single model. """
+    def __init__(self, model, elapsed, pushed=0, pulled=0, error=None):
+        self.model = model
+        self.elapsed = elapsed
+        self.pushed = pushed
+        self.pulled = pulled
+        self.error = error
+
+    def __repr__(self):
+        return "<ModelStats {0}: {1} pushed, {2} pulled in {3:.3f}s>".format(self.model._meta.name,
+                                                                          self.pushed,
+                                                                          self.pulled,
+                                                                          self.elapsed)
+
+
+class SyncStats(object):
+    """ Result of a SyncEngine run. """
+    def __init__(self, models, elapsed):
+        self.models = models
+        self.elapsed = elapsed
+
+    @property
+    def pushed(self):
+        return sum(s.pushed for s in self.models)
+
+    @property
+    def pulled(self):
+        return sum(s.pulled for s in self.models)
+
+    @property
+    def errors(self):
+        return [s for s in self.models if s.error is not None]
+
+    @property
+    def throughput(self):
+        """ History entries processed per second. """
+        if not self.elapsed:
+            return 0.0
+        return (self.pushed + self.pulled) / self.elapsed
+
+    @property
+    def max_latency(self):
+        return max([s.elapsed for s in self.models] or [0.0])
+
+    @property
+    def mean_latency(self):
+        if not self.models:
+            return 0.0
+        return sum(s.elapsed for s in self.models) / len(self.models)
+
+    def report(self):
+        return {"models": len(self.models),
+                "elapsed": self.elapsed,
+                "pushed": self.pushed,
+                "pulled": self.pulled,
+                "errors": len(self.errors),
+                "throughput": self.throughput,
+                "mean_latency": self.mean_latency,
+                "max_latency": self.max_latency}
+
+
+class SyncEngine(object):
+    """ Sync several models concurrently, using a pool of threads.
+
+    Each model is pushed then pulled by a single thread, so its History
+    is still processed in order. Database accesses are serialized with
+    model.db_lock, so the database must share a single connection between
+    threads (threadlocals=False, check_same_thread=False).
+
+    :type models: list
+    :param models: Models to sync, all the SyncedModel subclasses by default.
+
+    :type concurrency: int
+    :param concurrency: Max number of models synced at the same time.
+
+    """
+    def __init__(self, models=None, concurrency=4, debug=False):
+        self.models = models
+        self.concurrency = concurrency
+        self.debug = debug
+
+    def get_models(self):
+        if self.models is not None:
+            return list(self.models)
+        return synced_models()
+
+    def sync_model(self, model):
+        start = time.time()
+        pushed = pulled = 0
+        error = None
+        try:
+            pushed = model.sync_push(self.debug)
+            pulled = model.sync_pull(self.debug)
+        except CircuitOpen, exc:
+            log.warning("Sync of {0} skipped: {1}".format(model._meta.name, exc))
+            error = exc
+        except Exception, exc:
+            log.error("Error while syncing {0}".format(model._meta.name))
+            log.exception(exc)
+            error = exc
+        return ModelStats(model, time.time() - start, pushed, pulled, error)
+
+    def sync(self, models=None):
+        """ Sync all the models, or only the given ones.
+
+        :rtype: SyncStats
+
+        """
+        start = time.time()
+        if models is None:
+            models = self.get_models()
+        pool = ThreadPool(max(1, min(self.concurrency, len(models))))
+        try:
+            results = pool.map(self.sync_model, models)
+        finally:
+            pool.close()
+            pool.join()
+        stats = SyncStats(results, time.time() - start)
+        log.info("Synced %(models)s models in %(elapsed).3fs: %(pushed)s pushed, %(pulled)s pulled, "
+                 "%(errors)s errors", stats.report())
+        return stats
@@ -0,0 +1,96 @@
+# encoding: utf-8
+import logging
+import threading
+import time
+
+from engine import synced_models
+from metrics import metrics
+from remote import poll_remote_history
+
+log = logging.getLogger(__name__)
+
+
+class SyncFeed(object):
+    """ Background thread applying the remote History as soon as it is available,
+    instead of polling the API on each sync.
+
+    A single long-polling request covers all the models, starting from their pull
+    cursors. Entries are applied like in SyncedModel.sync_pull, along with the
+    cursors, so the feed resumes where it stopped after a disconnection or a restart.
+    On errors, it reconnects with an exponential backoff.
+
+    All the models must use the same transport. Fresh clients should be synced
+    (or bootstrapped) before starting the feed.
+
+    :type models: list
+    :param models: Models followed, all the SyncedModel subclasses by default.
+
+    :type wait: float
+    :param wait: Seconds the API may hold each request. If the API doesn't support
+                 long-poll, the feed polls it every wait seconds.
+
+    :type retry_delay: float
+    :param retry_delay: Seconds before reconnecting after the first error,
+                        doubled after each error up to max_retry_delay.
+
+    """
+    def __init__(self, models=None, wait=30, retry_delay=1, max_retry_delay=60, debug=False):
+        self.models = list(models or synced_models())
+        self.wait = wait
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+        self.debug = debug
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def poll(self):
+        """ Wait for remote History entries, and apply them.
+
+        :return: Number of entries received.
+
+        """
+        models = dict((m._meta.name, m) for m in self.models)
+        cursors = dict((name, m.get_pull_cursor(m.Sync.filter)) for name, m in models.items())
+        transport = self.models[0].Sync.transport
+        page_size = max(m.Sync.page_size for m in self.models)
+        entries = poll_remote_history(cursors, page_size, self.wait, transport=transport)
+        for name, model in models.items():
+            page = [h for h in entries if h["model"] == name]
+            if page:
+                applied, _ = model._sync_pull_page(page, cursors[name], model.Sync.filter, self.debug)
+                metrics.incr("pull.items", applied)
+        metrics.incr("feed.items", len(entries))
+        return len(entries)
+
+    def start(self):
+        if self.thread is not None:
+            return
+        self.stopped.clear()
+        self.thread = threading.Thread(target=self.run, name="peewee-eve-sync-feed")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self, timeout=None):
+        """ Stop the feed, a long-polling request in progress is not interrupted. """
+        if self.thread is None:
+            return
+        self.stopped.set()
+        self.thread.join(timeout)
+        self.thread = None
+
+    def run(self):
+        delay = self.retry_delay
+        while not self.stopped.is_set():
+            start = time.time()
+            try:
+                received = self.poll()
+            except Exception, exc:
+                metrics.incr("feed.errors")
+                log.warning("Change feed disconnected (%s), reconnecting in %ss", exc, delay)
+                self.stopped.wait(delay)
+                delay = min(delay * 2, self.max_retry_delay)
+                continue
+            delay = self.retry_delay
+            if not received:
+                # The API replied right away without any entry, it doesn't support long-poll
+                self.stopped.wait(max(0, self.wait - (time.time() - start)))
@@ -0,0 +1,202 @@
+# encoding: utf-8
+from collections import OrderedDict, defaultdict
+import json
+import logging
+import threading
+import time
+import urlparse
+import uuid
+
+import encoding
+from encoding import document
+from merkle import MerkleTree
+
+log = logging.getLogger(__name__)
+
+
+def match(doc, where):
+    """ Return True if a document matches an Eve where (subset of the MongoDB query language). """
+    for k, f in where.items():
+        if k == "$or":
+            if not any(match(doc, w) for w in f):
+                return False
+            continue
+        value = doc.get(k)
+        if isinstance(f, dict):
+            for op, arg in f.items():
+                if op == "$in" and value not in arg:
+                    return False
+                elif op == "$nin" and value in arg:
+                    return False
+                elif op == "$gt" and not value > arg:
+                    return False
+                elif op == "$gte" and not value >= arg:
+                    return False
+                elif op == "$lt" and not value < arg:
+                    return False
+                elif op == "$lte" and not value <= arg:
+                    return False
+                elif op == "$ne" and value == arg:
+                    return False
+        elif value != f:
+            return False
+    return True
+
+
+class LocalApi(object):
+    """ In-process, in-memory stand-in for the Eve API, to be used with a LocalTransport.
+
+    It implements what peewee_eve_sync relies on: bulk POST, PATCH and DELETE
+    with If-Match, GET with where/sort/pagination and long-poll, the hash trees used by
+    SyncedModel.sync_reconcile, and counts the calls and the bytes exchanged.
+    Unlike HTTPretty, it can be used from several threads.
+
+    Request bodies can be form-encoded, JSON or msgpack, and gzipped,
+    responses are encoded with msgpack if the client accepts it.
+
+    :type pk_maps: dict
+    :param pk_maps: Primary key field of each resource, default_pk for the others.
+
+    :type latency: float
+    :param latency: Seconds waited before serving each call, to simulate the network.
+
+    """
+    def __init__(self, pk_maps=None, default_pk="uuid", latency=0):
+        self.pk_maps = dict(pk_maps or {})
+        self.pk_maps.setdefault("history", "uuid")
+        self.default_pk = default_pk
+        self.latency = latency
+        self.resources = defaultdict(OrderedDict)
+        self.lock = threading.Lock()
+        # Notified on each write, for the long-polling requests
+        self.changed = threading.Condition(self.lock)
+        self.reset_stats()
+
+    def reset_stats(self):
+        with self.lock:
+            self.stats = {"calls": defaultdict(int),
+                          "status": defaultdict(int),
+                          "bytes_received": 0,
+                          "bytes_sent": 0}
+
+    @property
+    def round_trips(self):
+        return sum(self.stats["calls"].values())
+
+    def pk(self, resource):
+        return self.pk_maps.get(resource, self.default_pk)
+
+    def __call__(self, request):
+        if self.latency:
+            time.sleep(self.latency)
+        url = urlparse.urlparse(request.url)
+        path = [p for p in url.path.split("/") if p]
+        # /api/<resource>/[<pk>/]
+        resource = path[1]
+        pk = path[2] if len(path) > 2 else None
+        body = request.body or ""
+        data = body
+        if request.headers.get("Content-Encoding") == "gzip":
+            data = encoding.decompress(data)
+        content_type = request.headers.get("Content-Type", encoding.JSON)
+        if content_type.startswith("application/x-www-form-urlencoded"):
+            form = dict((k, v[0]) for k, v in urlparse.parse_qs(data).items())
+        else:
+            form = encoding.unpack(data, content_type)
+        response_type = encoding.JSON
+        if encoding.msgpack is not None and encoding.MSGPACK in request.headers.get("Accept", ""):
+            response_type = encoding.MSGPACK
+        with self.lock:
+            status, resp = self.handle(request.method, resource, pk,
+                                       urlparse.parse_qs(url.query),
+                                       form,
+                                       request.headers.get("If-Match"))
+            resp = encoding.pack(resp, response_type)
+            self.stats["calls"][request.method] += 1
+            self.stats["status"][status] += 1
+            self.stats["bytes_received"] += len(body)
+            self.stats["bytes_sent"] += len(resp)
+            if request.method != "GET":
+                self.changed.notify_all()
+        return status, {"Content-Type": response_type}, resp
+
+    def handle(self, method, resource, pk, query, form, if_match):
+        if resource == "_merkle" and method == "GET":
+            return 200, self.merkle(pk, query)
+        items = self.resources[resource]
+        if method == "GET" and pk is None:
+            return 200, self.get_collection_wait(resource, query)
+        elif method == "GET":
+            if pk not in items:
+                return 404, {}
+            return 200, items[pk]
+        elif method == "POST":
+            return 200, dict((key, self.post(resource, dict(document(doc))))
+                             for key, doc in form.items())
+        if pk not in items:
+            return 404, {}
+        if if_match != items[pk]["etag"]:
+            return 412, {}
+        if method == "PATCH":
+            doc = dict(items[pk])
+            doc.update(document(form["data"]))
+            doc["etag"] = uuid.uuid4().hex
+            items[pk] = doc
+            return 200, {"data": {"status": "OK", "etag": doc["etag"]}}
+        elif method == "DELETE":
+            del items[pk]
+            return 200, {}
+        return 405, {}
+
+    def _filter(self, resource, query):
+        docs = self.resources[resource].values()
+        if "where" in query:
+            where = json.loads(query["where"][0])
+            docs = [doc for doc in docs if match(doc, where)]
+        return docs
+
+    def merkle(self, resource, query):
+        """ Node hashes, or leaf items, of the hash tree of a collection (see remote.RemoteMerkleTree). """
+        pk_field = self.pk(resource)
+        tree = MerkleTree([(doc[pk_field], doc["etag"]) for doc in self._filter(resource, query)],
+                          int(query["depth"][0]))
+        if "leaves" in query:
+            return {"_items": [list(pair) for pair in tree.items(json.loads(query["leaves"][0]))]}
+        return {"hashes": tree.hash_many(json.loads(query["prefixes"][0]))}
+
+    def get_collection_wait(self, resource, query):
+        """ With the wait parameter, hold the request until the collection
+        has matching documents or wait seconds have elapsed (long-poll). """
+        deadline = time.time() + float(query.get("wait", [0])[0])
+        resp = self.get_collection(resource, query)
+        while not resp["_items"] and time.time() < deadline:
+            self.changed.wait(deadline - time.time())
+            resp = self.get_collection(resource, query)
+        return resp
+
+    def get_collection(self, resource, query):
+        docs = self._filter(resource, query)
+        if "sort" in query:
+            sort = json.loads(query["sort"][0])
+            if isinstance(sort, dict):
+                sort = sort.items()
+            # Stable sorts, from the last key to the first one
+            for k, direction in reversed(sort):
+                docs = sorted(docs, key=lambda doc: doc.get(k), reverse=direction == -1)
+        page = int(query.get("page", [1])[0])
+        max_results = int(query.get("max_results", [25])[0])
+        resp = {"_items": docs[(page - 1) * max_results:page * max_results], "_links": {}}
+        if page * max_results < len(docs):
+            resp["_links"]["next"] = {"href": "{0}/?page={1}".format(resource, page + 1)}
+        return resp
+
+    def post(self, resource, doc):
+        pk_field = self.pk(resource)
+        pk = doc.get(pk_field)
+        if pk in self.resources[resource]:
+            return {"status": "ERR",
+                    "issues": ["value '{0}' for field '{1}' not unique".format(pk, pk_field)]}
+        doc["etag"] = uuid.uuid4().hex
+        self.resources[resource][pk] = doc
+        return {"status": "OK", "etag": doc["etag"]}
+
@@ -0,0 +1,76 @@
+# encoding: utf-8
+""" Hash trees over (pk, etag) pairs, to find the resources diverging
+between the local database and the API without comparing them all.
+
+Each pair goes to the leaf named after the first depth hex digits of md5(pk),
+each node is named after its prefix ("" being the root) and has 16 children.
+The hash of a leaf is the md5 of its sorted pairs, the hash of any
+other node the md5 of the hashes of its children, and empty nodes have
+an empty hash. Both sides must use the same depth.
+
+"""
+import hashlib
+
+HEX = "0123456789abcdef"
+
+# Number of levels below the root, 16 ** DEPTH leaves
+DEPTH = 3
+
+EMPTY = ""
+
+
+def _encode(value):
+    if isinstance(value, unicode):
+        return value.encode("utf-8")
+    return str(value)
+
+
+def bucket(pk, depth=DEPTH):
+    """ Name of the leaf a pk belongs to. """
+    return hashlib.md5(_encode(pk)).hexdigest()[:depth]
+
+
+class MerkleTree(object):
+    """ Hash tree built in memory from (pk, etag) pairs. """
+    def __init__(self, pairs, depth=DEPTH):
+        self.depth = depth
+        self.leaves = {}
+        for pk, etag in pairs:
+            self.leaves.setdefault(bucket(pk, depth), []).append((pk, etag))
+        self.hashes = {}
+        for prefix, items in self.leaves.items():
+            self.hashes[prefix] = hashlib.md5("".join("{0}\0{1}\n".format(_encode(pk), _encode(etag))
+                                                      for pk, etag in sorted(items))).hexdigest()
+        # Build the upper levels, from the leaves to the root
+        for length in range(depth - 1, -1, -1):
+            parents = set(prefix[:length] for prefix in self.hashes if len(prefix) == length + 1)
+            for parent in parents:
+                self.hashes[parent] = hashlib.md5("".join(self.hashes.get(parent + c, EMPTY) + ","
+                                                          for c in HEX)).hexdigest()
+
+    def hash_many(self, prefixes):
+        """ Return the hashes of several nodes, as a dict prefix => hash. """
+        return dict((prefix, self.hashes.get(prefix, EMPTY)) for prefix in prefixes)
+
+    def items(self, leaves):
+        """ Return the (pk, etag) pairs of several leaves. """
+        return [pair for leaf in leaves for pair in self.leaves.get(leaf, [])]
+
+
+def diff(local, remote, depth=DEPTH):
+    """ Compare two trees top-down, only descending into the diverging nodes.
+
+    :param local: MerkleTree, or any object with the same hash_many method.
+    :param remote: Idem, e.g. a remote.RemoteMerkleTree.
+
+    :return: Names of the diverging leaves.
+
+    """
+    prefixes = [EMPTY]
+    for length in range(depth + 1):
+        local_hashes = local.hash_many(prefixes)
+        remote_hashes = remote.hash_many(prefixes)
+        prefixes = [p for p in prefixes if local_hashes[p] != remote_hashes.get(p, EMPTY)]
+        if not prefixes or length == depth:
+            return prefixes
+        prefixes = [p + c for p in prefixes for c in HEX]
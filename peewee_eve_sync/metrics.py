@@ -0,0 +1,123 @@
+# encoding: utf-8
+from contextlib import contextmanager
+from collections import defaultdict
+import functools
+import logging
+import threading
+import time
+
+import peewee
+
+log = logging.getLogger(__name__)
+
+
+class Histogram(object):
+    """ Count, sum, min and max of observed values. """
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+
+    def observe(self, value):
+        self.count += 1
+        self.total += value
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+
+    @property
+    def mean(self):
+        return self.total / self.count if self.count else 0.0
+
+    def to_dict(self):
+        return {"count": self.count, "sum": self.total, "min": self.min,
+                "max": self.max, "mean": self.mean}
+
+
+class Metrics(object):
+    """ Counters and histograms collected while syncing.
+
+    Hooks are called for each event with (kind, name, value),
+    kind being "counter" or "histogram", e.g. to forward them to statsd.
+
+    Recorded metrics:
+
+    - http.<verb>, http.bytes_sent, http.bytes_received, http.errors, http.conflicts (counters)
+    - http.latency (histogram)
+    - sql.queries (counter), sql.latency (histogram), only for an InstrumentedSqliteDatabase
+    - push.items, push.failures, push.leased, pull.items, bootstrap.items, reconcile.items, feed.items, feed.errors (counters)
+    - sync.push, sync.pull, sync.pull.apply, sync.bootstrap, sync.reconcile (histograms, seconds per model)
+
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.hooks = []
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.counters = defaultdict(int)
+            self.histograms = defaultdict(Histogram)
+
+    def add_hook(self, hook):
+        self.hooks.append(hook)
+
+    def remove_hook(self, hook):
+        self.hooks.remove(hook)
+
+    def _call_hooks(self, kind, name, value):
+        for hook in self.hooks:
+            try:
+                hook(kind, name, value)
+            except Exception, exc:
+                log.exception(exc)
+
+    def incr(self, name, value=1):
+        with self.lock:
+            self.counters[name] += value
+        if self.hooks:
+            self._call_hooks("counter", name, value)
+
+    def observe(self, name, value):
+        with self.lock:
+            self.histograms[name].observe(value)
+        if self.hooks:
+            self._call_hooks("histogram", name, value)
+
+    @contextmanager
+    def timer(self, name):
+        """ Observe the time spent in the block, in seconds. """
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.observe(name, time.time() - start)
+
+    def timed(self, name):
+        """ Decorator observing the time spent in a function, in seconds. """
+        def decorator(fn):
+            @functools.wraps(fn)
+            def wrapper(*args, **kwargs):
+                with self.timer(name):
+                    return fn(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def snapshot(self):
+        with self.lock:
+            return {"counters": dict(self.counters),
+                    "histograms": dict((k, h.to_dict()) for k, h in self.histograms.items())}
+
+
+metrics = Metrics()
+
+
+class InstrumentedSqliteDatabase(peewee.SqliteDatabase):
+    """ SqliteDatabase recording the number and latency of the SQL queries. """
+    def execute_sql(self, sql, params=None, require_commit=True):
+        start = time.time()
+        try:
+            return super(InstrumentedSqliteDatabase, self).execute_sql(sql, params, require_commit)
+        finally:
+            metrics.incr("sql.queries")
+            metrics.observe("sql.latency", time.time() - start)
@@ -1,57 +1,111 @@
 # -*- coding: utf-8 -*-
 import peewee
-from peewee import Query, not_allowed
-from datetime import datetime
+from peewee import UpdateQuery, DeleteQuery, InsertQuery
+from playhouse.migrate import SqliteMigrator, migrate
+from collections import OrderedDict
+from contextlib import contextmanager
+import inspect
 import json
 import logging
+import os
+import socket
+import threading
+import time
 import uuid
 
-from remote import (get_remote_history,
+import requests
+
+from remote import (iter_remote_history,
+                    history_key,
+                    get_last_remote_history,
                     get_resource,
+                    get_resources,
+                    iter_resources,
+                    RemoteMerkleTree,
+                    MAX_PKS_PER_QUERY,
                     post_resource,
+                    post_resources,
+                    post_history,
                     patch_resource,
-                    delete_resource)
+                    delete_resource,
+                    is_known,
+                    set_known)
+from transport import default_transport, CircuitOpen
+from metrics import metrics, InstrumentedSqliteDatabase
+from clock import get_ts, clock
+from bloom import BloomFilter
+import merkle
+from merkle import MerkleTree
+import encoding
+from encoding import document
 
 log = logging.getLogger(__name__)
 
-db = peewee.SqliteDatabase(None)
 
+class SyncDatabase(InstrumentedSqliteDatabase):
+    """ SqliteDatabase applying pragmas to each new connection.
+
+    :type pragmas: list
+    :param pragmas: (name, value) pairs, e.g. WAL_PRAGMAS.
+
+    :type threadlocals: bool
+    :param threadlocals: Also accepted by init, False shares a single connection
+                         between threads (see engine.SyncEngine).
+
+    """
+    pragmas = ()
+
+    def init(self, database, pragmas=None, threadlocals=None, **connect_kwargs):
+        if pragmas is not None:
+            self.pragmas = list(pragmas)
+        if threadlocals is not None:
+            # peewee only sets up the connection state in the constructor
+            super(SyncDatabase, self).__init__(database, threadlocals=threadlocals,
+                                               autocommit=self.autocommit,
+                                               autorollback=self.autorollback, **connect_kwargs)
+        else:
+            super(SyncDatabase, self).init(database, **connect_kwargs)
+
+    def _add_conn_hooks(self, conn):
+        super(SyncDatabase, self)._add_conn_hooks(conn)
+        for name, value in self.pragmas:
+            conn.execute("PRAGMA {0} = {1}".format(name, value))
+
+
+# Readers don't block behind writers, and commits don't wait for the disk
+# (a commit may be lost on power failure, but the database stays consistent)
+WAL_PRAGMAS = [("journal_mode", "wal"),
+               ("synchronous", "normal"),
+               # KB, negative values are in KB instead of pages
+               ("cache_size", -16000)]
+
+db = SyncDatabase(None)
+
+# Serialize the database accesses performed while syncing, and the writes
+# recording History, since models may be synced from several threads
+# (see engine.SyncEngine).
+db_lock = threading.RLock()
+
+# Seconds of remote History pulled again before the pull cursor, for the entries
+# stamped by other clients before the cursor but posted after it (see SeenHistoryIndex)
 SYNC_BUFFER = 2
 
-"""
-class UpdateQuerySync(Query):
-    def __init__(self, model_class, update=None):
-        self._update = update
-        self.is_synced = issubclass(model_class, SyncedModel)
-        if update and self.is_synced:
-            for k, v in update.items():
-                print k, type(k), k.__dict__, v
-            self.update_data = dict([(k.db_column, v) for k, v in update.items()])
-            print self.update_data
-        super(UpdateQuerySync, self).__init__(model_class)
-
-    def clone(self):
-        query = super(UpdateQuerySync, self).clone()
-        query._update = dict(self._update)
-        return query
-
-    join = not_allowed('joining')
-
-    def sql(self):
-        return self.compiler().generate_update(self)
+# Max number of parameters in a single SQLite query
+SQLITE_MAX_VARIABLES = 500
 
-    def execute(self):
-        _execute = self._execute()
-        _return = self.database.rows_affected(_execute)
-        if self.is_synced:
-            self.model_class.sync_auto()
-        return _return
+# Max number of ETags kept in memory
+ETAG_CACHE_SIZE = 10000
 
-peewee.UpdateQuery = UpdateQuerySync
-"""
+# Only newer peewee versions validate the fields of multi-rows inserts
+INSERT_VALIDATE_FIELDS = "validate_fields" in inspect.getargspec(InsertQuery.__init__).args
+
+# Number of History uuids the SeenHistory bloom filter is first sized for
+SEEN_HISTORY_CAPACITY = 100000
 
-def get_ts():
-    return int(datetime.utcnow().strftime("%s"))
+# Seconds before retrying to push a History entry after its first failure,
+# doubled after each failure up to RETRY_MAX_DELAY
+RETRY_DELAY = 2
+RETRY_MAX_DELAY = 3600
 
 """
 
@@ -73,16 +127,44 @@ def get_ts():
 class SyncSettings:
     auto = False
     pk = "uuid"
+    # Number of History entries sent per bulk request during push,
+    # 1 disables batching (one request per entry).
+    batch_size = 1
+    # POST creates without checking first if the resource exists,
+    # the API must enforce the uniqueness of the pk.
+    optimistic_create = False
+    # Transport used to reach the API (see transport.Transport)
+    transport = default_transport
+    # Number of remote History entries fetched per request during pull
+    page_size = 50
+    # Background worker used for auto sync (see worker.SyncWorker),
+    # if None, auto sync is performed synchronously.
+    worker = None
+    # Seconds synced History entries are kept before being pruned,
+    # None to keep them forever.
+    history_retention = 7 * 24 * 3600
+    # Only sync a subset of the model, as a (peewee expression, Eve where) tuple,
+    # e.g. (Model.cat == "cat1", {"cat": "cat1"}), None syncs the whole model.
+    filter = None
+    # Download the current state of the collection on the first pull,
+    # instead of replaying the whole remote History (see SyncedModel.sync_bootstrap).
+    bootstrap = False
+    # Number of resources fetched per request, and inserted per transaction, during bootstrap
+    bootstrap_page_size = 500
+    # Seconds a process keeps the push lease of the model without renewing it (see Lease),
+    # so a single process pushes at a time when several ones share the database,
+    # None disables the lease.
+    lease_ttl = 60
 
 
 class JsonField(peewee.CharField):
     """Custom JSON field."""
     def db_value(self, value):
-        return json.dumps(value)
+        return encoding.dumps(value)
 
     def python_value(self, value):
         try:
-            return json.loads(value)
+            return encoding.loads(value)
         except:
             return value
 
@@ -104,39 +186,139 @@ class KeyValue(BaseModel):
 
     @classmethod
     def get_key(self, key, default=None):
-        try:
-            return KeyValue.get(KeyValue.key == key).value
-        except KeyValue.DoesNotExist:
-            return default
+        with db_lock:
+            try:
+                return KeyValue.get(KeyValue.key == key).value
+            except KeyValue.DoesNotExist:
+                return default
 
     @classmethod
     def set_key(self, key, value=None):
-        q = KeyValue.select().where(KeyValue.key == key)
-        if q.count():
-            KeyValue.update(value=value).where(KeyValue.key == key).execute()
-        else:
-            KeyValue.create(key=key, value=value)
+        with db_lock:
+            q = KeyValue.select().where(KeyValue.key == key)
+            if q.count():
+                KeyValue.update(value=value).where(KeyValue.key == key).execute()
+            else:
+                KeyValue.create(key=key, value=value)
+
+
+class ETag(BaseModel):
+    """ Last known ETag of each synced resource. """
+    model = peewee.CharField()
+    pk = peewee.CharField()
+    etag = peewee.CharField()
+
+    class Meta:
+        db_table = 'etag'
+        indexes = (
+            (('model', 'pk'), True),
+        )
+
+
+class ETagStore(object):
+    """ ETag store, with an in-memory LRU cache in front of the ETag table.
+
+    Writes go through the cache directly to the database,
+    and missing ETags are cached too.
+
+    The cache is reset each time the ETag table database changes.
+
+    """
+    def __init__(self, size=ETAG_CACHE_SIZE):
+        self.size = size
+        self.cache = OrderedDict()
+        self.database = None
+        self.lock = db_lock
+
+    def _check_database(self):
+        if ETag._meta.database is not self.database:
+            self.cache.clear()
+            self.database = ETag._meta.database
+
+    def _cache(self, key, etag):
+        self.cache.pop(key, None)
+        self.cache[key] = etag
+        if len(self.cache) > self.size:
+            self.cache.popitem(last=False)
+
+    def get(self, model, pk):
+        with self.lock:
+            self._check_database()
+            key = (model, pk)
+            if key in self.cache:
+                etag = self.cache.pop(key)
+                self.cache[key] = etag
+                return etag
+            try:
+                etag = ETag.get(ETag.model == model, ETag.pk == pk).etag
+            except ETag.DoesNotExist:
+                etag = None
+            self._cache(key, etag)
+            return etag
+
+    def set(self, model, pk, etag):
+        with self.lock:
+            self._check_database()
+            ETag.insert(model=model, pk=pk, etag=etag).upsert().execute()
+            self._cache((model, pk), etag)
+
+    def delete(self, model, pk):
+        with self.lock:
+            self._check_database()
+            ETag.delete().where(ETag.model == model, ETag.pk == pk).execute()
+            self._cache((model, pk), None)
+
+    def load(self, model, pks):
+        """ Load the ETags of several resources in the cache,
+        with one query per SQLITE_MAX_VARIABLES pks. """
+        with self.lock:
+            self._check_database()
+            pks = [pk for pk in set(pks) if (model, pk) not in self.cache]
+            for i in range(0, len(pks), SQLITE_MAX_VARIABLES):
+                chunk = pks[i:i + SQLITE_MAX_VARIABLES]
+                found = dict(ETag.select(ETag.pk, ETag.etag)
+                                 .where(ETag.model == model, ETag.pk << chunk)
+                                 .tuples())
+                for pk in chunk:
+                    self._cache((model, pk), found.get(pk))
+
+    def set_many(self, model, pk_etags):
+        """ Set several ETags at once, None ETags are deleted. """
+        with self.lock:
+            self._check_database()
+            upserts = [{"model": model, "pk": pk, "etag": etag}
+                       for pk, etag in pk_etags.items() if etag is not None]
+            deletes = [pk for pk, etag in pk_etags.items() if etag is None]
+            for i in range(0, len(upserts), SQLITE_MAX_VARIABLES / 3):
+                ETag.insert_many(upserts[i:i + SQLITE_MAX_VARIABLES / 3]).upsert().execute()
+            for i in range(0, len(deletes), SQLITE_MAX_VARIABLES):
+                chunk = deletes[i:i + SQLITE_MAX_VARIABLES]
+                ETag.delete().where(ETag.model == model, ETag.pk << chunk).execute()
+            for pk, etag in pk_etags.items():
+                self._cache((model, pk), etag)
+
+    def clear(self):
+        with self.lock:
+            self.cache.clear()
+
+etags = ETagStore()
 
 
 def get_etag(model, pk):
-    try:
-        return KeyValue.get_key("etag:{0}:{1}".format(model, pk))
-    except:
-        return
+    return etags.get(model, pk)
 
 
 def set_etag(model, pk, etag):
-    KeyValue.set_key("etag:{0}:{1}".format(model, pk), etag)
+    etags.set(model, pk, etag)
 
 
 def delete_etag(model, pk):
-    try:
-        key = "etag:{0}:{1}".format(model, pk)
-        kv = KeyValue.get(KeyValue.key == key)
-        kv.delete_instance()
-    except:
-        # TODO voir pq
-        return
+    etags.delete(model, pk)
+
+def _history_data(data):
+    """ Copy of History data, stored as a JSON string by older versions. """
+    return dict(document(data))
+
 
 class History(BaseModel):
     """ History for sync.
@@ -150,25 +332,524 @@ class History(BaseModel):
     model = peewee.CharField(index=True)
     pk = peewee.CharField()
     uuid = peewee.CharField()
+    # Orders the entries sharing the same ts (see clock.HybridClock)
+    seq = peewee.IntegerField(default=0)
+    is_synced = peewee.BooleanField(default=False)
+    # Resource written on the API, the History entry itself not posted yet
+    is_applied = peewee.BooleanField(default=False)
+    # Failed push attempts, and timestamp before which the entry must not be retried
+    attempts = peewee.IntegerField(default=0)
+    retry_at = peewee.IntegerField(default=0)
 
     @classmethod
     def create(cls, **attributes):
-        """ Safe create, without syncing things. """
+        """ Safe create, without syncing things, timestamped by the clock if ts is missing. """
         attributes["uuid"] = uuid.uuid4()
+        if "ts" not in attributes:
+            attributes["ts"], attributes["seq"] = clock.now()
         return super(History, cls).create(**attributes)
 
-    @property
-    def is_synced(self):
-        return KeyValue.get_key("history:{0}".format(self.uuid), False)
-
     def synced(self):
-        KeyValue.set_key("history:{0}".format(self.uuid), True)
+        History.mark_synced([self.id])
+        self.is_synced = True
+
+    def applied(self):
+        History.mark_applied([self.id])
+        self.is_applied = True
+
+    @classmethod
+    def mark_synced(cls, ids):
+        """ Mark History entries as synced with a single UPDATE. """
+        with db_lock:
+            for i in range(0, len(ids), SQLITE_MAX_VARIABLES):
+                chunk = ids[i:i + SQLITE_MAX_VARIABLES]
+                cls.update(is_synced=True).where(cls.id << chunk).execute()
+
+    @classmethod
+    def mark_applied(cls, ids):
+        """ Mark History entries as written on the API, their History still to be posted. """
+        with db_lock:
+            for i in range(0, len(ids), SQLITE_MAX_VARIABLES):
+                chunk = ids[i:i + SQLITE_MAX_VARIABLES]
+                cls.update(is_applied=True).where(cls.id << chunk).execute()
+
+    @classmethod
+    def mark_failed(cls, histories, now):
+        """ Record a failed push attempt, and schedule the next one with an exponential backoff. """
+        with db_lock:
+            for history in histories:
+                history.attempts += 1
+                history.retry_at = now + min(RETRY_MAX_DELAY, RETRY_DELAY * 2 ** (history.attempts - 1))
+                cls.update(attempts=history.attempts,
+                           retry_at=history.retry_at).where(cls.id == history.id).execute()
+
+    @classmethod
+    def pending(cls, model):
+        """ History entries not synced yet for the given model. """
+        return cls.select().where(cls.model == model,
+                                  cls.is_synced == False).order_by(cls.ts, cls.seq, cls.id)
+
+    @classmethod
+    def create_many(cls, rows):
+        """ Create several History entries with multi-rows INSERTs, without syncing things.
+
+        :type rows: list
+        :param rows: dicts with the data, action, model and pk keys,
+                     each row is timestamped by the clock.
+
+        """
+        rows = [dict(row, uuid=uuid.uuid4()) for row in rows]
+        for row in rows:
+            row["ts"], row["seq"] = clock.now()
+        # Every column but the id is inserted
+        size = SQLITE_MAX_VARIABLES / (len(cls._meta.fields) - 1)
+        with db_lock:
+            for i in range(0, len(rows), size):
+                cls.insert_many(rows[i:i + size]).execute()
+
+    @classmethod
+    def compact(cls, histories):
+        """ Fold the History entries of each pk into the minimal set of operations.
+
+        create + updates becomes a single create with the merged data,
+        updates are merged together, and anything followed by a delete
+        is dropped (along with the delete itself if the chain started with a create).
+        Entries already written on the API (is_applied) are never folded.
+        Folded entries are removed from the database.
+
+        :type histories: list
+        :param histories: Pending History entries, ordered by ts.
+
+        :return: The compacted History entries, in the same order.
+
+        """
+        chains = {}
+        merged = {}
+        folded = set()
+        for history in histories:
+            chain = chains.setdefault(history.pk, [])
+            last = chain[-1] if chain else None
+            if history.is_applied or last is not None and last.is_applied:
+                chain.append(history)
+            elif history.action == "update" and last is not None and last.action in ("create", "update"):
+                data = _history_data(last.data)
+                data.update(_history_data(history.data))
+                last.data = data
+                merged[last.id] = last
+                folded.add(history.id)
+            elif history.action == "delete" and last is not None and last.action == "create":
+                chain.pop()
+                folded.update([last.id, history.id])
+            elif history.action == "delete" and last is not None and last.action == "update":
+                chain.pop()
+                chain.append(history)
+                folded.add(last.id)
+            else:
+                chain.append(history)
+
+        if not folded:
+            return histories
+        ids = list(folded)
+        with db_lock:
+            with cls._meta.database.atomic():
+                for history in merged.values():
+                    if history.id not in folded:
+                        cls.update(data=history.data).where(cls.id == history.id).execute()
+                for i in range(0, len(ids), SQLITE_MAX_VARIABLES):
+                    cls.delete().where(cls.id << ids[i:i + SQLITE_MAX_VARIABLES]).execute()
+        return [h for h in histories if h.id not in folded]
+
+    @classmethod
+    def prune(cls, model, before):
+        """ Delete the synced History entries of a model older than the given timestamp.
+
+        :return: Number of deleted entries.
+
+        """
+        with db_lock:
+            return cls.delete().where(cls.model == model,
+                                      cls.is_synced == True,
+                                      cls.ts < before).execute()
 
     def __repr__(self):
         return "<History: {model}/{action}/{uuid}>".format(**self._data)
 
     class Meta:
         db_table = 'history'
+        indexes = (
+            # pending History entries for a model
+            (('model', 'is_synced', 'ts'), False),
+        )
+
+
+class SeenHistory(BaseModel):
+    """ uuid of the History entries pushed or pulled by this client. """
+    uuid = peewee.CharField(primary_key=True)
+    model = peewee.CharField()
+    ts = peewee.IntegerField()
+
+    class Meta:
+        db_table = 'seenhistory'
+        indexes = (
+            (('model', 'ts'), False),
+        )
+
+
+class SeenHistoryIndex(object):
+    """ Index of the History entries already pushed or pulled, so they are skipped
+    when pulled (again), with a bloom filter in front of the SeenHistory table.
+
+    Most pulled entries have never been seen, and are ruled out by the bloom filter
+    without any query, the others are checked against the table.
+
+    The bloom filter is built from the table each time its database changes,
+    and rebuilt twice as large once full.
+
+    """
+    def __init__(self, capacity=SEEN_HISTORY_CAPACITY):
+        self.capacity = capacity
+        self.bloom = None
+        self.database = None
+        self.lock = db_lock
+
+    def _check_database(self):
+        if SeenHistory._meta.database is not self.database or self.bloom.is_full:
+            self.database = SeenHistory._meta.database
+            uuids = [u for u, in SeenHistory.select(SeenHistory.uuid).tuples()]
+            capacity = self.capacity
+            while capacity <= len(uuids):
+                capacity *= 2
+            self.bloom = BloomFilter(capacity)
+            for u in uuids:
+                self.bloom.add(u)
+
+    def seen(self, uuids):
+        """ Return the subset of uuids already seen. """
+        with self.lock:
+            self._check_database()
+            candidates = [u for u in uuids if u in self.bloom]
+            seen = set()
+            for i in range(0, len(candidates), SQLITE_MAX_VARIABLES):
+                chunk = candidates[i:i + SQLITE_MAX_VARIABLES]
+                seen.update(u for u, in SeenHistory.select(SeenHistory.uuid)
+                                                  .where(SeenHistory.uuid << chunk)
+                                                  .tuples())
+            return seen
+
+    def add_many(self, model, uuid_ts):
+        """ Record several seen History entries.
+
+        :type uuid_ts: list
+        :param uuid_ts: List of (uuid, ts).
+
+        """
+        with self.lock:
+            self._check_database()
+            rows = [{"uuid": str(u), "model": model, "ts": ts} for u, ts in uuid_ts]
+            for i in range(0, len(rows), SQLITE_MAX_VARIABLES / 3):
+                SeenHistory.insert_many(rows[i:i + SQLITE_MAX_VARIABLES / 3]).upsert().execute()
+            for row in rows:
+                self.bloom.add(row["uuid"])
+
+    def prune(self, model, before):
+        """ Forget the entries of a model older than the given timestamp,
+        they stay in the bloom filter until it is rebuilt. """
+        with self.lock:
+            return SeenHistory.delete().where(SeenHistory.model == model,
+                                              SeenHistory.ts < before).execute()
+
+    def clear(self):
+        with self.lock:
+            self.database = None
+
+seen_history = SeenHistoryIndex()
+
+
+class LeaseLost(Exception):
+    """ Raised when a lease expired and was taken over by another owner. """
+
+
+def lease_owner():
+    """ Owner of the leases taken by the current thread, host:pid:thread. """
+    return "{0}:{1}:{2}".format(socket.gethostname(), os.getpid(), threading.current_thread().ident)
+
+
+class Lease(BaseModel):
+    """ Lease held by a single owner at a time, shared by all the processes using the database.
+
+    Leases are claimed and renewed with a single conditional UPDATE (or INSERT),
+    atomic even across processes. A lease not renewed before expires_at can be
+    taken over, so a crashed owner only blocks the others for the lease ttl.
+
+    """
+    name = peewee.CharField(primary_key=True)
+    owner = peewee.CharField()
+    expires_at = peewee.IntegerField()
+
+    @classmethod
+    def acquire(cls, name, owner, ttl):
+        """ Claim a lease, or renew it if already held by owner.
+
+        :return: True if owner holds the lease for ttl seconds.
+
+        """
+        now = get_ts()
+        with db_lock:
+            claimed = cls.update(owner=owner, expires_at=now + ttl).where(
+                cls.name == name, (cls.owner == owner) | (cls.expires_at < now)).execute()
+            if claimed:
+                return True
+            try:
+                with cls._meta.database.atomic():
+                    cls.insert(name=name, owner=owner, expires_at=now + ttl).execute()
+            except peewee.IntegrityError:
+                # Held by another owner
+                return False
+            return True
+
+    @classmethod
+    def release(cls, name, owner):
+        with db_lock:
+            cls.delete().where(cls.name == name, cls.owner == owner).execute()
+
+
+class LeaseKeeper(object):
+    """ Lease held during a long task, renewed once half of its ttl elapsed.
+
+    :type ttl: int
+    :param ttl: Seconds the lease lasts without being renewed.
+
+    """
+    def __init__(self, name, ttl):
+        self.name = name
+        self.ttl = ttl
+        self.owner = lease_owner()
+        self.renewed_at = None
+
+    def acquire(self):
+        if not Lease.acquire(self.name, self.owner, self.ttl):
+            return False
+        self.renewed_at = time.time()
+        return True
+
+    def keep(self):
+        """ Renew the lease if needed, raise LeaseLost if it was taken over meanwhile. """
+        if time.time() - self.renewed_at >= self.ttl / 2.0 and not self.acquire():
+            raise LeaseLost(self.name)
+
+    def release(self):
+        Lease.release(self.name, self.owner)
+
+
+# Models holding the sync metadata, History stays along with the synced models,
+# since its entries are recorded in the same transactions as the changes.
+META_MODELS = (KeyValue, ETag, SeenHistory, Lease)
+
+
+def init_meta_database(database, create_tables=True):
+    """ Store the sync metadata (cursors, ETags, seen History uuids, leases) in their own database,
+    e.g. SyncDatabase("sync.db", pragmas=WAL_PRAGMAS), instead of the main one.
+
+    Metadata writes don't contend anymore with the application writes.
+    Transactions covering both are committed in two steps, the synced models first:
+    on a crash in between, remote changes are applied again instead of being lost.
+
+    """
+    with db_lock:
+        for model in META_MODELS:
+            model._meta.database = database
+            if create_tables:
+                model.create_table(fail_silently=True)
+        etags.clear()
+        seen_history.clear()
+
+
+@contextmanager
+def _sync_atomic(database):
+    """ Transaction over a database and the sync metadata database (see init_meta_database). """
+    meta = KeyValue._meta.database
+    if meta is database:
+        with database.atomic():
+            yield
+    else:
+        # Exited in reverse order, the data is committed before the metadata
+        with meta.atomic(), database.atomic():
+            yield
+
+
+def migrate_sync_state():
+    """ Migrate a database created with an older version.
+
+    The synced flags stored as history:<uuid> KeyValue are moved to the
+    History is_synced column, and the etag:<model>:<pk> KeyValue to the ETag table.
+    The History seq, retry and is_applied columns, and the SeenHistory and Lease tables are added.
+
+    """
+    database = History._meta.database
+    with database.transaction():
+        ETag.create_table(fail_silently=True)
+        SeenHistory.create_table(fail_silently=True)
+        Lease.create_table(fail_silently=True)
+        seen_history.clear()
+        for kv in KeyValue.select().where(KeyValue.key.startswith("etag:")):
+            _, model, pk = kv.key.split(":", 2)
+            ETag.insert(model=model, pk=pk, etag=kv.value).upsert().execute()
+        KeyValue.delete().where(KeyValue.key.startswith("etag:")).execute()
+        etags.clear()
+
+        columns = [c.name for c in database.get_columns(History._meta.db_table)]
+        migrator = SqliteMigrator(database)
+        # Columns are added before the index, since adding a column rebuilds the indexes
+        operations = [migrator.add_column(History._meta.db_table, field.db_column, field)
+                      for field in (History.seq, History.is_synced, History.is_applied,
+                                    History.attempts, History.retry_at)
+                      if field.db_column not in columns]
+        if "is_synced" not in columns:
+            operations.append(migrator.add_index(History._meta.db_table, ("model", "is_synced", "ts"), False))
+        migrate(*operations)
+
+        flags = KeyValue.select().where(KeyValue.key.startswith("history:"))
+        uuids = [kv.key[len("history:"):] for kv in flags if kv.value]
+        for i in range(0, len(uuids), SQLITE_MAX_VARIABLES):
+            chunk = uuids[i:i + SQLITE_MAX_VARIABLES]
+            History.update(is_synced=True).where(History.uuid << chunk).execute()
+        KeyValue.delete().where(KeyValue.key.startswith("history:")).execute()
+
+
+class PullChanges(object):
+    """ Local changes resulting from a page of remote History,
+    applied all at once (see SyncedModel.sync_pull). """
+    def __init__(self, model):
+        self.model = model
+        self.created = OrderedDict()
+        self.updated = OrderedDict()
+        self.deleted = set()
+        self.etags = {}
+
+    def _pk(self, instance):
+        return getattr(instance, self.model.Sync.pk)
+
+    def get_etag(self, pk):
+        if pk in self.etags:
+            return self.etags[pk]
+        return get_etag(self.model._meta.name, pk)
+
+    def create(self, instance, etag):
+        pk = self._pk(instance)
+        self.created[pk] = instance
+        self.etags[pk] = etag
+
+    def update(self, instance, etag):
+        pk = self._pk(instance)
+        if pk not in self.created:
+            self.updated[pk] = instance
+        self.etags[pk] = etag
+
+    def delete(self, instance):
+        pk = self._pk(instance)
+        if self.created.pop(pk, None) is None:
+            self.updated.pop(pk, None)
+            self.deleted.add(pk)
+        self.etags[pk] = None
+
+    def apply(self):
+        """ Apply the changes, deletes and creates are performed
+        with one query per SQLITE_MAX_VARIABLES parameters. """
+        model = self.model
+        pk_field = getattr(model, model.Sync.pk)
+        deleted = list(self.deleted)
+        for i in range(0, len(deleted), SQLITE_MAX_VARIABLES):
+            model._delete().where(pk_field << deleted[i:i + SQLITE_MAX_VARIABLES]).execute()
+
+        # Rows of a multi-rows INSERT must have the same fields
+        rows = {}
+        for instance in self.created.values():
+            data = dict(instance._data)
+            rows.setdefault(tuple(sorted(data.keys())), []).append(data)
+        for fields, group in rows.items():
+            size = max(1, SQLITE_MAX_VARIABLES / len(fields))
+            for i in range(0, len(group), size):
+                model._insert_many(group[i:i + size]).execute()
+
+        for instance in self.updated.values():
+            instance._save(only=instance.dirty_fields)
+
+        etags.set_many(model._meta.name, self.etags)
+
+
+def _matching_pks(query):
+    """ Return the (id, pk) of the rows matched by an update/delete query. """
+    model = query.model_class
+    select = model._select(model._meta.primary_key, getattr(model, model.Sync.pk))
+    if query._where is not None:
+        select = select.where(query._where)
+    return list(select.tuples())
+
+
+class SyncedUpdateQuery(UpdateQuery):
+    """ UpdateQuery recording an update History entry for each updated row. """
+    def execute(self):
+        model = self.model_class
+        fields = self._update.keys()
+        with db_lock:
+            with self.database.atomic():
+                ids = [id for id, pk in _matching_pks(self)]
+                rows = super(SyncedUpdateQuery, self).execute()
+                # Values are read back, since they may be expressions (e.g. Model.count + 1)
+                histories = []
+                for i in range(0, len(ids), SQLITE_MAX_VARIABLES):
+                    chunk = ids[i:i + SQLITE_MAX_VARIABLES]
+                    select = model._select(getattr(model, model.Sync.pk), *fields)
+                    for values in select.where(model._meta.primary_key << chunk).tuples():
+                        data = dict((f.name, v) for f, v in zip(fields, values[1:]))
+                        histories.append({"data": data, "action": "update",
+                                          "model": model._meta.name, "pk": values[0]})
+                History.create_many(histories)
+        model.sync_auto(write=True)
+        return rows
+
+
+class SyncedDeleteQuery(DeleteQuery):
+    """ DeleteQuery recording a delete History entry for each deleted row. """
+    def execute(self):
+        model = self.model_class
+        with db_lock:
+            with self.database.atomic():
+                matched = _matching_pks(self)
+                rows = super(SyncedDeleteQuery, self).execute()
+                History.create_many([{"data": {}, "action": "delete",
+                                      "model": model._meta.name, "pk": pk} for id, pk in matched])
+        model.sync_auto(write=True)
+        return rows
+
+
+class SyncedInsertQuery(InsertQuery):
+    """ InsertQuery recording a create History entry for each inserted row. """
+    def _fill_defaults(self):
+        """ Key the rows by field name, with the field defaults filled in
+        (evaluated once, so the History holds the inserted values). """
+        fields = self.model_class._meta.fields.values()
+        rows = []
+        for row in self._rows:
+            data = dict((k.name if isinstance(k, peewee.Field) else k, v) for k, v in row.items())
+            for field in fields:
+                if field.default is not None and field.name not in data:
+                    data[field.name] = field.default() if callable(field.default) else field.default
+            rows.append(data)
+        self._rows = rows
+
+    def execute(self):
+        model = self.model_class
+        self._fill_defaults()
+        with db_lock:
+            with self.database.atomic():
+                rows = super(SyncedInsertQuery, self).execute()
+                histories = [{"data": dict(data), "action": "create",
+                              "model": model._meta.name, "pk": data.get(model.Sync.pk)}
+                             for data in self._rows]
+                History.create_many(histories)
+        model.sync_auto(write=True)
+        return rows
 
 
 class SyncedModel(BaseModel):
@@ -185,10 +866,13 @@ class SyncedModel(BaseModel):
         return "<{0} {1} (sync)>".format(self._meta.name, self._data.get(self.Sync.pk))
 
     @classmethod
-    def sync_auto(cls):
+    def sync_auto(cls, write=False):
         if cls.Sync.auto and cls._meta.name != "history":
             log.debug("trigger sync auto")
-            cls.sync()
+            if cls.Sync.worker is not None:
+                cls.Sync.worker.trigger(cls, write)
+            else:
+                cls.sync()
 
     @classmethod
     def _select(cls, *selection):
@@ -202,56 +886,146 @@ class SyncedModel(BaseModel):
 
     @classmethod
     def create(cls, **attributes):
-        if cls._meta.name != "history":
-            History.create(data=json.dumps(dict(**attributes)),
-                           ts=get_ts(),
-                           action="create",
-                           model=cls._meta.name,
-                           pk=attributes.get(cls.Sync.pk))
-        return super(SyncedModel, cls).create(**attributes)
+        # The History entry is recorded in the same transaction as the row
+        with db_lock:
+            with cls._meta.database.atomic():
+                if cls._meta.name != "history":
+                    History.create(data=dict(**attributes),
+                                   action="create",
+                                   model=cls._meta.name,
+                                   pk=attributes.get(cls.Sync.pk))
+                inst = cls._create(**attributes)
+        cls.sync_auto(write=True)
+        return inst
 
     @classmethod
     def _create(cls, **attributes):
         """ Safe create, without syncing things. """
-        return super(SyncedModel, cls).create(**attributes)
+        inst = cls(**attributes)
+        inst._save(force_insert=True)
+        return inst
 
     def save(self, force_insert=False, only=None):
-        if self._meta.name != "history" and self.get_id():
-            # we perform an update
-            update_data = dict(self._data)
-            if "id" in update_data:
-                del update_data["id"]
-
-            History.create(data=json.dumps(update_data),
-                           ts=get_ts(),
-                           action="update",
-                           model=self._meta.name,
-                           pk=self._data.get(self.Sync.pk))
-
-        _return = super(SyncedModel, self).save(force_insert=False, only=None)
-        self.sync_auto()
+        update_data = None
+        if self._meta.name != "history" and self.get_id() and not force_insert:
+            # we perform an update, only the modified fields are tracked and saved
+            dirty_fields = [f for f in self.dirty_fields if f.name != "id"]
+            if only is None:
+                if not dirty_fields:
+                    # Nothing to save
+                    return 0
+                only = dirty_fields
+            saved = set(f.name for f in only)
+            update_data = dict((f.name, self._data.get(f.name)) for f in dirty_fields if f.name in saved)
+
+        with db_lock:
+            with self._meta.database.atomic():
+                if update_data:
+                    History.create(data=update_data,
+                                   action="update",
+                                   model=self._meta.name,
+                                   pk=self._data.get(self.Sync.pk))
+                _return = self._save(force_insert=force_insert, only=only)
+        self.sync_auto(write=True)
 
         return _return
 
     def _save(self, force_insert=False, only=None):
         """ Safe save, without syncing things. """
-        return super(SyncedModel, self).save(force_insert=False, only=None)
+        with db_lock:
+            # Same as peewee, but with queries that don't record History
+            field_dict = dict(self._data)
+            if only is not None:
+                field_dict = self._prune_fields(field_dict, only)
+            if self.get_id() is None or force_insert:
+                pk = self._insert(**field_dict).execute()
+                if pk is not None:
+                    self.set_id(pk)
+                self._clear_dirty(only)
+                return 1
+            field_dict.pop(self._meta.primary_key.name, None)
+            if not field_dict:
+                return 0
+            rows = self._update(**field_dict).where(self._pk_expr()).execute()
+            self._clear_dirty(only)
+            return rows
+
+    def _clear_dirty(self, only=None):
+        """ The fields not saved are still modified. """
+        if only is None:
+            self._dirty.clear()
+        else:
+            self._dirty.difference_update(f.name for f in only)
 
     def delete_instance(self):
-        if self._meta.name != "history":
-            History.create(data={},
-                           ts=get_ts(),
-                           action="delete",
-                           model=self._meta.name,
-                           pk=self._data.get(self.Sync.pk))
-        _return = super(SyncedModel, self).delete_instance()
-        self.sync_auto()
+        with db_lock:
+            with self._meta.database.atomic():
+                if self._meta.name != "history":
+                    History.create(data={},
+                                   action="delete",
+                                   model=self._meta.name,
+                                   pk=self._data.get(self.Sync.pk))
+                _return = self._delete_instance()
+        self.sync_auto(write=True)
 
         return _return
 
     def _delete_instance(self):
         """ Safe delete_instance, without syncing things. """
-        return super(SyncedModel, self).delete_instance()
+        with db_lock:
+            return self._delete().where(self._pk_expr()).execute()
+
+    @classmethod
+    def _field_dict(cls, data, kwargs):
+        """ Merge the data (keyed by fields or names) and keyword arguments of a query. """
+        fdict = dict((cls._meta.fields[f] if isinstance(f, basestring) else f, v)
+                     for f, v in (data or {}).items())
+        fdict.update((cls._meta.fields[f], v) for f, v in kwargs.items())
+        return fdict
+
+    @classmethod
+    def update(cls, __data=None, **update):
+        """ Update query recording History entries for the updated rows. """
+        return SyncedUpdateQuery(cls, cls._field_dict(__data, update))
+
+    @classmethod
+    def _update(cls, **update):
+        """ Safe update, without syncing things. """
+        return super(SyncedModel, cls).update(**update)
+
+    @classmethod
+    def delete(cls):
+        """ Delete query recording History entries for the deleted rows. """
+        return SyncedDeleteQuery(cls)
+
+    @classmethod
+    def _delete(cls):
+        """ Safe delete, without syncing things. """
+        return super(SyncedModel, cls).delete()
+
+    @classmethod
+    def insert(cls, __data=None, **insert):
+        """ Insert query recording a History entry for the inserted row. """
+        return SyncedInsertQuery(cls, cls._field_dict(__data, insert))
+
+    @classmethod
+    def _insert(cls, **insert):
+        """ Safe insert, without syncing things. """
+        return super(SyncedModel, cls).insert(**insert)
+
+    @classmethod
+    def insert_many(cls, rows, validate_fields=True):
+        """ Multi-rows insert recording History entries for the inserted rows. """
+        if INSERT_VALIDATE_FIELDS:
+            return SyncedInsertQuery(cls, rows=rows, validate_fields=validate_fields)
+        return SyncedInsertQuery(cls, rows=rows)
+
+    @classmethod
+    def _insert_many(cls, rows, validate_fields=True):
+        """ Safe insert_many, without syncing things. """
+        if INSERT_VALIDATE_FIELDS:
+            return super(SyncedModel, cls).insert_many(rows, validate_fields=validate_fields)
+        return super(SyncedModel, cls).insert_many(rows)
 
     @classmethod
     def get(cls, *query, **kwargs):
@@ -268,22 +1042,63 @@ class SyncedModel(BaseModel):
             sq = sq.filter(**kwargs)
         return sq.get()
 
+    @classmethod
+    def get_by_pks(cls, pks):
+        """ Get several models from their primary keys.
+
+        :return: dict pk => model, missing models are not included.
+
+        """
+        pk_field = getattr(cls, cls.Sync.pk)
+        pks = list(set(pks))
+        models = {}
+        with db_lock:
+            for i in range(0, len(pks), SQLITE_MAX_VARIABLES):
+                chunk = pks[i:i + SQLITE_MAX_VARIABLES]
+                for model in cls._select().where(pk_field << chunk):
+                    models[getattr(model, cls.Sync.pk)] = model
+        return models
+
     @classmethod
     def get_by_pk(cls, pk):
         """ Try to get a model from its primary key. """
-        try:
-            return cls._get(getattr(cls, cls.Sync.pk) == pk)
-        except cls.DoesNotExist:
-            return None
+        with db_lock:
+            try:
+                return cls._get(getattr(cls, cls.Sync.pk) == pk)
+            except cls.DoesNotExist:
+                return None
+
+    @classmethod
+    def _cursor_key(cls, direction, filter=None):
+        key = "last_dev_eve_sync_{0}:{1}".format(direction, cls._meta.name)
+        if filter is not None:
+            # Each filter has its own cursors, identified by its Eve where
+            key += ":" + json.dumps(filter[1], sort_keys=True)
+        return key
+
+    @classmethod
+    def get_cursor(cls, direction, filter=None):
+        """ Return the timestamp of the last push/pull of this model. """
+        if filter is not None:
+            return KeyValue.get_key(cls._cursor_key(direction, filter), 0)
+        # Databases created with an older version only have a global cursor
+        default = KeyValue.get_key("last_dev_eve_sync_{0}".format(direction), 0)
+        return KeyValue.get_key(cls._cursor_key(direction), default)
+
+    @classmethod
+    def set_cursor(cls, direction, ts, filter=None):
+        KeyValue.set_key(cls._cursor_key(direction, filter), ts)
 
     @classmethod
-    def sync(cls, debug=True):
+    def sync(cls, debug=True, filter=None):
         if debug:
             log.debug("Starting sync")
 
         try:
-            cls.sync_push(debug)
-            cls.sync_pull(debug)
+            cls.sync_push(debug, filter)
+            cls.sync_pull(debug, filter)
+        except CircuitOpen, exc:
+            log.warning("Sync skipped: {0}".format(exc))
         except Exception, exc:
             log.error("Error while syncing")
             log.exception(exc)
@@ -292,103 +1107,645 @@ class SyncedModel(BaseModel):
             log.debug("End sync")
 
     @classmethod
-    def sync_push(cls, debug=False):
-        """ Process the local History and perform calls to the API. """
+    @metrics.timed("sync.push")
+    def sync_push(cls, debug=False, filter=None):
+        """ Process the local History and perform calls to the API.
+
+        :type filter: tuple
+        :param filter: Only push the models matching this filter, Sync.filter by default.
+
+        Failed entries are retried on the next pushes with an exponential backoff,
+        the following entries of the same model waiting for them.
+        Every pending entry is pushed whatever its timestamp, since the processes
+        sharing the database don't share their clock (see clock.HybridClock).
+
+        When several processes share the database, the pending History of the model
+        is claimed with a Lease first, so it is pushed by a single process,
+        the others skipping the push until the lease is released or expires.
+
+        :return: Number of History entries acknowledged.
+
+        """
         # 1. PUSH
         if debug:
             log.debug("starting push")
 
-        last_sync = KeyValue.get_key("last_dev_eve_sync_push", 0)
-        if last_sync:
-            last_sync -= SYNC_BUFFER
-        for history in History.select().where(History.model == cls._meta.name,
-                                              History.ts >= last_sync):
+        lease = None
+        if cls.Sync.lease_ttl is not None:
+            lease = LeaseKeeper("push:{0}".format(cls._meta.name), cls.Sync.lease_ttl)
+            if not lease.acquire():
+                log.debug("%s is pushed by another process", cls._meta.name)
+                metrics.incr("push.leased")
+                return 0
+        try:
+            return cls._sync_push(lease, debug, filter)
+        finally:
+            if lease is not None:
+                lease.release()
+
+    @classmethod
+    def _sync_push(cls, lease, debug, filter):
+        filter = filter or cls.Sync.filter
+        now = get_ts()
+        with db_lock:
+            histories = list(History.pending(cls._meta.name))
+            if filter is not None:
+                histories = cls._filter_histories(histories, filter[0])
+        # Models with an entry waiting for a retry are left untouched, to keep their entries in order
+        waiting = set(h.pk for h in histories if h.retry_at > now)
+        ready = History.compact([h for h in histories if h.pk not in waiting])
+        etags.load(cls._meta.name, [h.pk for h in ready if h.action != "create"])
+        failed = []
+        try:
+            if cls.Sync.batch_size > 1:
+                cls._sync_push_batch(ready, failed, debug, lease)
+            else:
+                blocked = set()
+                for history in ready:
+                    if lease is not None:
+                        lease.keep()
+                    if history.pk in blocked:
+                        continue
+                    try:
+                        cls._sync_push_history(history, debug)
+                    except CircuitOpen:
+                        raise
+                    except Exception, exc:
+                        log.error("Error while pushing {0}".format(history))
+                        log.exception(exc)
+                    if not history.is_synced:
+                        failed.append(history)
+                        blocked.add(history.pk)
+        except LeaseLost:
+            # The remaining entries are pushed by the new owner
+            log.warning("Push lease of %s lost, push interrupted", cls._meta.name)
+        finally:
+            metrics.incr("push.failures", len(failed))
+            History.mark_failed(failed, now)
+            # Our own entries are skipped when pulled
+            seen_history.add_many(cls._meta.name, [(h.uuid, h.ts) for h in ready if h.is_synced])
+
+        if cls.Sync.history_retention is not None:
+            History.prune(cls._meta.name, now - cls.Sync.history_retention)
+            seen_history.prune(cls._meta.name, now - cls.Sync.history_retention)
+        pushed = len([h for h in ready if h.is_synced])
+        metrics.incr("push.items", pushed)
+        return pushed
+
+    @classmethod
+    def _filter_histories(cls, histories, expression):
+        """ Keep the History entries of the models matching a peewee expression.
+
+        Deletes are always kept, since the deleted models can't be matched anymore,
+        and so are the updates of models already synced (with an ETag), which may
+        have left the filter. The other entries stay pending, and are pushed
+        once their model enters the filter.
+
+        """
+        pk_field = getattr(cls, cls.Sync.pk)
+        pks = list(set(h.pk for h in histories if h.action != "delete"))
+        matching = set()
+        for i in range(0, len(pks), SQLITE_MAX_VARIABLES):
+            chunk = pks[i:i + SQLITE_MAX_VARIABLES]
+            matching.update(pk for pk, in cls._select(pk_field).where(expression, pk_field << chunk).tuples())
+        updated = list(set(h.pk for h in histories if h.action == "update" and h.pk not in matching))
+        synced = set()
+        for i in range(0, len(updated), SQLITE_MAX_VARIABLES):
+            chunk = updated[i:i + SQLITE_MAX_VARIABLES]
+            synced.update(pk for pk, in ETag.select(ETag.pk).where(ETag.model == cls._meta.name,
+                                                                  ETag.pk << chunk).tuples())
+        return [h for h in histories
+                if h.action == "delete" or h.pk in matching or h.action == "update" and h.pk in synced]
+
+    @classmethod
+    def _sync_push_history(cls, history, debug=False):
+        """ Push a single History entry to the API.
+
+        The entry is only synced once its History is posted, until then
+        it is kept as applied, and only its History is posted again.
+
+        """
+        if debug:
+            log.debug("history.is_synced %s", history.is_synced)
+
+        if not history.is_synced:
             if debug:
-                log.debug("history.is_synced {0}".format(history.is_synced))
+                log.debug("current local history: %s", history)
+
+            if history.is_applied:
+                # Written on the API by a previous push, only its History is left
+                pass
+            elif history.action == "create":
+                etag = post_resource(history.model, history.pk, history.data,
+                                     raw_history=history._data,
+                                     optimistic=cls.Sync.optimistic_create,
+                                     push_history=False,
+                                     transport=cls.Sync.transport)
+                if etag:
+                    set_etag(history.model, history.pk, etag)
+                    history.applied()
+                elif is_known(history.model, history.pk, transport=cls.Sync.transport):
+                    # Already created on the API, maybe by a push which failed to post the History
+                    if cls._fetch_etag(history):
+                        history.applied()
+            elif history.action == "update":
+                etag = get_etag(history.model, history.pk)
+                new_etag = patch_resource(history.model, history.pk, history.data, etag,
+                                          raw_history=history._data, push_history=False,
+                                          transport=cls.Sync.transport)
+                # We update the etag locally
+                if new_etag:
+                    set_etag(history.model, history.pk, new_etag)
+                    history.applied()
+            elif history.action == "delete":
+                etag = get_etag(history.model, history.pk)
+                if delete_resource(history.model, history.pk, etag, raw_history=history._data,
+                                   push_history=False, transport=cls.Sync.transport):
+                    history.applied()
+                else:
+                    history.synced()
+                if etag:
+                    delete_etag(history.model, history.pk)
 
-            if not history.is_synced:
-                if debug:
-                    log.debug("current local history: {0}".format(history))
-
-                if history.action == "create":
-                    etag = post_resource(history.model, history.pk, history.data, raw_history=history._data)
-                    if etag:
-                        set_etag(history.model, history.pk, etag)
-                        history.synced()
-                elif history.action == "update":
-                    etag = get_etag(history.model, history.pk)
-                    new_etag = patch_resource(history.model, history.pk, history.data, etag, raw_history=history._data)
-                    # We update the etag locally
-                    if new_etag:
-                        set_etag(history.model, history.pk, new_etag)
-                        history.synced()
-                elif history.action == "delete":
-                    etag = get_etag(history.model, history.pk)
-                    delete_resource(history.model, history.pk, etag, raw_history=history._data)
+            if history.is_applied and not history.is_synced:
+                if post_history([history._data], transport=cls.Sync.transport)[0]:
                     history.synced()
-                    if etag:
-                        delete_etag(history.model, history.pk)
 
-        KeyValue.set_key("last_dev_eve_sync_push", get_ts())
+    @classmethod
+    def _fetch_etag(cls, history):
+        """ Return the ETag of a resource already created on the API,
+        fetched if unknown locally, so it can be updated afterwards.
+
+        :return: The ETag, None if the resource can't be fetched.
+
+        """
+        etag = get_etag(history.model, history.pk)
+        if etag is None:
+            remote = get_resource(history.model, history.pk, transport=cls.Sync.transport)
+            if remote:
+                etag = remote["etag"]
+                set_etag(history.model, history.pk, etag)
+        return etag
 
     @classmethod
-    def sync_pull(cls, debug=False):
-        last_sync = KeyValue.get_key("last_dev_eve_sync_pull", 0)
+    def _sync_push_batch(cls, histories, failed, debug=False, lease=None):
+        """ Push History entries using bulk requests.
+
+        Consecutive creates are sent together in a single POST,
+        and acknowledged History entries are posted by batches
+        of Sync.batch_size. An entry is only synced once its History is posted,
+        until then it is kept as applied, and only its History is posted again.
+
+        :type failed: list
+        :param failed: Filled with the History entries which failed.
+
+        :type lease: LeaseKeeper
+        :param lease: Push lease, renewed while pushing.
+
+        """
+        batch_size = cls.Sync.batch_size
+        creates = []
+        acked = []
+        blocked = set()
+
+        def flush_creates():
+            if not creates:
+                return
+            try:
+                etags = post_resources(cls._meta.name, [(h.pk, h.data) for h in creates],
+                                       transport=cls.Sync.transport)
+            except CircuitOpen:
+                raise
+            except Exception, exc:
+                log.error("Error while pushing {0} creates".format(len(creates)))
+                log.exception(exc)
+                etags = [None] * len(creates)
+            applied = []
+            for history, etag in zip(creates, etags):
+                if etag:
+                    set_etag(history.model, history.pk, etag)
+                    applied.append(history.id)
+                    history.is_applied = True
+                    acked.append(history)
+                else:
+                    failed.append(history)
+                    blocked.add(history.pk)
+            History.mark_applied(applied)
+            del creates[:]
+
+        def flush_acked():
+            try:
+                acks = post_history([h._data for h in acked], transport=cls.Sync.transport)
+            except CircuitOpen:
+                raise
+            except Exception, exc:
+                log.error("Error while pushing {0} History entries".format(len(acked)))
+                log.exception(exc)
+                acks = [False] * len(acked)
+            synced = []
+            for history, ack in zip(acked, acks):
+                if ack:
+                    synced.append(history.id)
+                    history.is_synced = True
+                else:
+                    failed.append(history)
+                    blocked.add(history.pk)
+            History.mark_synced(synced)
+            del acked[:]
+
+        try:
+            for history in histories:
+                if lease is not None:
+                    lease.keep()
+                if debug:
+                    log.debug("current local history: %s", history)
+
+                if history.is_applied:
+                    # Written on the API by a previous push, only its History is left
+                    acked.append(history)
+                elif history.action == "create":
+                    if is_known(history.model, history.pk, transport=cls.Sync.transport):
+                        # Already created on the API, maybe by a push which failed to post the History
+                        if cls._fetch_etag(history):
+                            history.applied()
+                            acked.append(history)
+                        else:
+                            failed.append(history)
+                            blocked.add(history.pk)
+                    else:
+                        creates.append(history)
+                        if len(creates) >= batch_size:
+                            flush_creates()
+                else:
+                    # Updates and deletes can't be batched,
+                    # and must be performed after pending creates.
+                    flush_creates()
+                    if history.pk in blocked:
+                        continue
+                    etag = get_etag(history.model, history.pk)
+                    try:
+                        if history.action == "update":
+                            new_etag = patch_resource(history.model, history.pk, history.data, etag,
+                                                      raw_history=history._data, push_history=False,
+                                                      transport=cls.Sync.transport)
+                            if new_etag:
+                                set_etag(history.model, history.pk, new_etag)
+                                history.applied()
+                                acked.append(history)
+                        elif history.action == "delete":
+                            if delete_resource(history.model, history.pk, etag,
+                                               raw_history=history._data, push_history=False,
+                                               transport=cls.Sync.transport):
+                                history.applied()
+                                acked.append(history)
+                            else:
+                                history.synced()
+                            if etag:
+                                delete_etag(history.model, history.pk)
+                    except CircuitOpen:
+                        raise
+                    except Exception, exc:
+                        log.error("Error while pushing {0}".format(history))
+                        log.exception(exc)
+                    if not history.is_synced and not history.is_applied:
+                        failed.append(history)
+                        blocked.add(history.pk)
+
+                if len(acked) >= batch_size:
+                    flush_acked()
+
+            flush_creates()
+        finally:
+            # Entries already applied remotely must have their History posted
+            if acked:
+                flush_acked()
+
+    @classmethod
+    @metrics.timed("sync.pull")
+    def sync_pull(cls, debug=False, filter=None):
+        """ Fetch the remote History page by page, and apply it locally.
+
+        With a filter, only the models matching its Eve where are fetched:
+        models entering the filter are created, and models leaving it
+        are removed locally.
+
+        :type filter: tuple
+        :param filter: Only pull the models matching this filter, Sync.filter by default.
+
+        The last SYNC_BUFFER seconds before the cursor are pulled again, the entries
+        pushed or already pulled by this client being skipped (see SeenHistoryIndex).
+        With Sync.bootstrap, the first pull downloads a snapshot instead (see sync_bootstrap).
+
+        :return: Number of remote History entries applied (plus the models created by the bootstrap).
+
+        """
+        filter = filter or cls.Sync.filter
+        cursor = cls.get_pull_cursor(filter)
+        count = 0
+        if cls.Sync.bootstrap and cursor["ts"] == 0:
+            count = cls.sync_bootstrap(filter)
+            cursor = cls.get_pull_cursor(filter)
 
         if debug:
             log.debug("starting pull")
 
         # 2. PULL
-        remote_history = get_remote_history(cls._meta.name, last_sync)
-        for history in remote_history:
-            log.info(history)
-            if debug:
-                log.debug("receiving remote history: {0}".format(history))
+        for page in iter_remote_history(cls._meta.name, cursor, cls.Sync.page_size, SYNC_BUFFER,
+                                        transport=cls.Sync.transport):
+            applied, cursor = cls._sync_pull_page(page, cursor, filter, debug)
+            count += applied
 
-            local = cls.get_by_pk(history["pk"])
+        metrics.incr("pull.items", count)
+        return count
 
-            if debug:
-                log.debug("local model version: {0}".format(local))
-
-            if history["action"] == "create":
-                if not local:
-                    if debug:
-                        log.debug("create from remote")
-                    # Create from history data
-                    cls._create(**json.loads(history["data"]))
-                    # Retrieve ETag from remote API
-                    remote = get_resource(history["model"], history["pk"])
-                    #print "REMOTE CREATE", remote, history
-                    if remote:
-                        set_etag(history["model"], history["pk"], remote["etag"])
-                        #print "ETAG", get_etag(history["model"], history["pk"])
-            elif history["action"] == "update":
-                local_etag = get_etag(history["model"], history["pk"])
-                # TODO voir pq le etag dans history
-                if local and local_etag:
-                    remote = get_resource(history["model"], history["pk"])
-                    if remote:  #  voir pq utile pour la deletion
-                        log.info("remote item to be updated: {0}".format(remote))
-                        log.info(local_etag)
-                        # The update is performed only if the remote model is different from local
-                        if local_etag != remote["etag"]:
-                            log.info(local._data)
-                            for k, v in json.loads(history["data"]).items():
-                                setattr(local, k, v)
-                            local._save()
-                            log.info("local update {0}".format(json.loads(history["data"])))
-                            set_etag(history["model"], history["pk"], remote["etag"])
-                elif debug:
-                    log.debug("item doesn't exists !")
+    @classmethod
+    def _sync_pull_page(cls, page, cursor, filter=None, debug=False):
+        """ Apply a page of remote History entries, in a single transaction
+        along with the new pull cursor, so an interrupted pull can be resumed.
+
+        :type cursor: dict
+        :param cursor: Pull cursor before the page (see get_pull_cursor).
+
+        :return: (number of entries applied, new pull cursor)
+
+        """
+        count = 0
+        page = sorted(page, key=history_key)
+        # Entries already pushed or pulled by this client, e.g. in the overlap before the cursor
+        skipped = seen_history.seen([h["uuid"] for h in page])
+        for history in page:
+            # Entries created from now on are ordered after the ones received
+            clock.update(history["ts"], history.get("seq", 0))
+        if page and history_key(page[-1]) > history_key(cursor):
+            cursor = {"ts": page[-1]["ts"], "seq": page[-1].get("seq", 0), "uuid": page[-1]["uuid"]}
+        page = [h for h in page if h["uuid"] not in skipped]
+        pks = [h["pk"] for h in page]
+        etags.load(cls._meta.name, pks)
+        # Fetch the local and remote versions of the whole page at once
+        local = cls.get_by_pks(pks)
+        # Remote versions are only needed to create missing models, and update existing ones
+        # (or missing ones, which may have entered the filter)
+        remote = get_resources(cls._meta.name,
+                               [h["pk"] for h in page
+                                if h["action"] == "create" and h["pk"] not in local or
+                                h["action"] == "update" and (h["pk"] in local or filter is not None)],
+                               cls.Sync.pk, where=filter and filter[1],
+                               transport=cls.Sync.transport)
+        pending = cls._pending_updates([h["pk"] for h in page if h["action"] == "update" and h["pk"] in local])
+        changes = PullChanges(cls)
+        for history in page:
+            local[history["pk"]] = cls._sync_pull_history(history,
+                                                          local.get(history["pk"]),
+                                                          remote.get(history["pk"]),
+                                                          changes, filter, debug,
+                                                          pending.get(history["pk"]))
+            count += 1
+        with db_lock:
+            try:
+                with metrics.timer("sync.pull.apply"), _sync_atomic(cls._meta.database):
+                    changes.apply()
+                    seen_history.add_many(cls._meta.name, [(h["uuid"], h["ts"]) for h in page])
+                    cls.set_cursor("pull", cursor, filter)
+            except Exception:
+                # Cached ETags may not match the rolled back table anymore
+                etags.clear()
+                seen_history.clear()
+                raise
+        return count, cursor
 
-            elif history["action"] == "delete":
-                if local:
-                    local._delete_instance()
-                    delete_etag(history["model"], history["pk"])
-                else:
-                    log.debug("Item already deleted")
+    @classmethod
+    @metrics.timed("sync.bootstrap")
+    def sync_bootstrap(cls, filter=None):
+        """ Download the current state of the model collection, page by page,
+        instead of replaying the whole remote History.
+
+        The pull cursor is then set to the latest remote History entry, fetched
+        before the snapshot, so the changes performed meanwhile are pulled afterwards.
+        Models already existing locally are left untouched, so an interrupted
+        bootstrap can be performed again.
+
+        :type filter: tuple
+        :param filter: Only download the models matching this filter, Sync.filter by default.
+
+        :return: Number of models created.
+
+        """
+        filter = filter or cls.Sync.filter
+        last = get_last_remote_history(cls._meta.name, transport=cls.Sync.transport)
+        count = 0
+        for page in iter_resources(cls._meta.name, cls.Sync.pk, cls.Sync.bootstrap_page_size,
+                                   where=filter and filter[1], transport=cls.Sync.transport):
+            local = cls.get_by_pks([doc[cls.Sync.pk] for doc in page])
+            changes = PullChanges(cls)
+            for doc in page:
+                if doc[cls.Sync.pk] not in local:
+                    changes.create(cls(**dict((k, v) for k, v in doc.items() if k in cls._meta.fields)),
+                                   doc["etag"])
+            with db_lock:
+                try:
+                    with _sync_atomic(cls._meta.database):
+                        changes.apply()
+                except Exception:
+                    etags.clear()
+                    raise
+            count += len(changes.created)
+
+        if last is not None:
+            clock.update(last["ts"], last.get("seq", 0))
+            cls.set_cursor("pull", {"ts": last["ts"], "seq": last.get("seq", 0), "uuid": last["uuid"]},
+                           filter)
+        metrics.incr("bootstrap.items", count)
+        return count
+
+    @classmethod
+    @metrics.timed("sync.reconcile")
+    def sync_reconcile(cls, depth=merkle.DEPTH, filter=None):
+        """ Find and repair the models diverging from the API, without downloading them all.
+
+        Hash trees of the (pk, ETag) pairs are compared top-down, the local one being
+        built from the ETag table and the remote one computed by the API
+        (see remote.RemoteMerkleTree), then only the resources of the diverging
+        leaves are fetched. If the API doesn't compute hash trees, the remote
+        one is built from the (pk, ETag) pairs of the whole collection.
+
+        Models with pending History entries are left to the next push.
+
+        :type filter: tuple
+        :param filter: Only reconcile the models matching this filter, Sync.filter by default.
+
+        :return: Number of models created, updated or deleted.
+
+        """
+        filter = filter or cls.Sync.filter
+        name = cls._meta.name
+        pk_field = getattr(cls, cls.Sync.pk)
+        where = filter and filter[1]
+        with db_lock:
+            query = ETag.select(ETag.pk, ETag.etag).where(ETag.model == name)
+            if filter is None:
+                local_etags = dict(query.tuples())
+            else:
+                # The ETag table may be in its own database (see init_meta_database)
+                pks = [pk for pk, in cls._select(pk_field).where(filter[0]).tuples()]
+                local_etags = {}
+                for i in range(0, len(pks), SQLITE_MAX_VARIABLES):
+                    local_etags.update(query.where(ETag.pk << pks[i:i + SQLITE_MAX_VARIABLES]).tuples())
+        local = MerkleTree(local_etags.items(), depth)
+        remote = RemoteMerkleTree(name, depth, where, transport=cls.Sync.transport)
+        try:
+            leaves = merkle.diff(local, remote, depth)
+        except requests.HTTPError, exc:
+            if exc.response is None or exc.response.status_code != 404:
+                raise
+            log.info("The API doesn't compute hash trees, fetching all the %s ETags", name)
+            remote = MerkleTree([(doc[cls.Sync.pk], doc["etag"])
+                                 for page in iter_resources(name, cls.Sync.pk, cls.Sync.bootstrap_page_size,
+                                                            where=where, transport=cls.Sync.transport)
+                                 for doc in page], depth)
+            leaves = merkle.diff(local, remote, depth)
+        if not leaves:
+            return 0
+
+        remote_etags = dict(remote.items(leaves))
+        with db_lock:
+            pending = set(h.pk for h in History.pending(name))
+        diverging = set(pk for pk, etag in local.items(leaves) if remote_etags.get(pk) != etag)
+        diverging.update(pk for pk, etag in remote_etags.items() if local_etags.get(pk) != etag)
+        diverging = [pk for pk in diverging if pk not in pending]
+        log.info("Reconciling %s %s", len(diverging), name)
+
+        # Fetched by chunks, the models of a chunk which failed are left to the next reconcile
+        fetch = [pk for pk in diverging if pk in remote_etags]
+        resources = {}
+        for i in range(0, len(fetch), MAX_PKS_PER_QUERY):
+            chunk = fetch[i:i + MAX_PKS_PER_QUERY]
+            try:
+                resources.update(get_resources(name, chunk, cls.Sync.pk, where=where,
+                                               transport=cls.Sync.transport))
+            except requests.RequestException, exc:
+                log.warning("Error while fetching %s %s to reconcile: %s", len(chunk), name, exc)
+                failed = set(chunk)
+                diverging = [pk for pk in diverging if pk not in failed]
+        models = cls.get_by_pks(diverging)
+        changes = PullChanges(cls)
+        for pk in diverging:
+            data = dict((k, v) for k, v in resources.get(pk, {}).items() if k in cls._meta.fields)
+            if pk not in resources:
+                # Deleted remotely (or not matching the filter anymore)
+                changes.delete(models.get(pk) or cls(**{cls.Sync.pk: pk}))
+            elif pk in models:
+                for k, v in data.items():
+                    setattr(models[pk], k, v)
+                changes.update(models[pk], resources[pk]["etag"])
+            else:
+                changes.create(cls(**data), resources[pk]["etag"])
+        with db_lock:
+            try:
+                with _sync_atomic(cls._meta.database):
+                    changes.apply()
+            except Exception:
+                etags.clear()
+                raise
+        metrics.incr("reconcile.items", len(diverging))
+        return len(diverging)
+
+    @classmethod
+    def get_pull_cursor(cls, filter=None):
+        """ Return the pull cursor: the (ts, seq, uuid) of the last remote History entry applied. """
+        cursor = cls.get_cursor("pull", filter)
+        if not isinstance(cursor, dict):
+            # Older versions only stored the timestamp of the last pull
+            cursor = {"ts": cursor}
+        if "uuid" not in cursor:
+            # Or the uuids of the entries applied at this timestamp, pulled again
+            cursor = {"ts": cursor["ts"], "seq": 0, "uuid": ""}
+        return cursor
+
+    @classmethod
+    def _pending_updates(cls, pks):
+        """ Return the fields of the local updates not pushed yet, as a dict pk => data. """
+        pending = {}
+        with db_lock:
+            for i in range(0, len(pks), SQLITE_MAX_VARIABLES):
+                query = History.pending(cls._meta.name).where(History.action == "update",
+                                                              History.pk << pks[i:i + SQLITE_MAX_VARIABLES])
+                for history in query:
+                    pending.setdefault(history.pk, {}).update(document(history.data))
+        return pending
+
+    @classmethod
+    def _sync_pull_history(cls, history, local, remote, changes, filter=None, debug=False, pending=None):
+        """ Apply a single remote History entry to the pending changes.
+
+        :param local: Local version of the model, None if it doesn't exist.
+        :param remote: Remote version of the model, None if it doesn't exist
+                       (or doesn't match the filter).
+        :param changes: PullChanges of the current page.
+        :param pending: Fields of the local updates not pushed yet, kept over the remote ones
+                        since they are applied remotely on the next push.
+
+        :return: The new local version of the model.
 
-        KeyValue.set_key("last_dev_eve_sync_pull", get_ts())
+        """
+        if debug:
+            log.debug("receiving remote history: %s", history)
+
+        if debug:
+            log.debug("local model version: %s", local)
+
+        if history["action"] == "create":
+            if not local:
+                if debug:
+                    log.debug("create from remote")
+                # The create is outdated if the resource has been deleted since.
+                if remote:
+                    # Create from the remote version, which matches the ETag, the history
+                    # data may be outdated by updates pulled later in the page
+                    local = cls(**dict((k, v) for k, v in remote.items() if k in cls._meta.fields))
+                    changes.create(local, remote["etag"])
+                elif debug:
+                    log.debug("item doesn't exists anymore !")
+        elif history["action"] == "update":
+            local_etag = changes.get_etag(history["pk"])
+            # TODO voir pq le etag dans history
+            if local and local_etag:
+                if remote:  #  voir pq utile pour la deletion
+                    log.info("remote item to be updated: %s", remote)
+                    log.info(local_etag)
+                    # The update is performed only if the remote model is different from local
+                    if local_etag != remote["etag"]:
+                        log.info(local._data)
+                        # The remote version, which matches the ETag, holds this update and the ones
+                        # pulled later in the page, which would be skipped as already applied
+                        for k, v in remote.items():
+                            if k in cls._meta.fields and k != cls._meta.primary_key.name:
+                                setattr(local, k, v)
+                        for k, v in (pending or {}).items():
+                            if k in cls._meta.fields:
+                                setattr(local, k, v)
+                        changes.update(local, remote["etag"])
+                        log.info("local update %s", history["data"])
+            elif filter is not None and not local and remote:
+                # The model entered the filter
+                local = cls(**dict((k, v) for k, v in remote.items() if k in cls._meta.fields))
+                changes.create(local, remote["etag"])
+            elif debug:
+                log.debug("item doesn't exists !")
+
+            if filter is not None and local and not remote:
+                # The model left the filter (or has been deleted)
+                changes.delete(local)
+                local = None
+
+        elif history["action"] == "delete":
+            if local:
+                changes.delete(local)
+                set_known(history["model"], history["pk"], False, transport=cls.Sync.transport)
+                local = None
+            else:
+                log.debug("Item already deleted")
+
+        return local
 
     class Sync(SyncSettings):
         pass
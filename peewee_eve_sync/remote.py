@@ -1,63 +1,241 @@
 # encoding: utf-8
-from datetime import datetime
+from collections import OrderedDict
 import json
-import requests
 import logging
+import threading
+
+from transport import default_transport
+from encoding import document
+from clock import clock
 
 log = logging.getLogger(__name__)
 
-api_root = "http://localhost/api/{0}/".format
-api_resource = "http://localhost/api/{0}/{1}/".format
+# Max number of resources remembered as existing on the API
+KNOWN_RESOURCES_SIZE = 10000
+
+# Max number of pks in the where of a single request, to keep the query string short
+MAX_PKS_PER_QUERY = 100
+
+# Max number of resources per page, Eve default PAGINATION_LIMIT
+MAX_RESULTS = 50
+
+# Seconds a long-poll request may take on top of the time the API holds it
+POLL_TIMEOUT_MARGIN = 10
+
+# History entries are ordered by (ts, seq, uuid), uuid breaking the ties between clients
+HISTORY_SORT = json.dumps([["ts", 1], ["seq", 1], ["uuid", 1]])
+
+
+class KnownResources(object):
+    """ LRU set of the (api_url, model, pk) of resources known to exist on the API. """
+    def __init__(self, size=KNOWN_RESOURCES_SIZE):
+        self.size = size
+        self.items = OrderedDict()
+        self.lock = threading.Lock()
+
+    def __contains__(self, key):
+        with self.lock:
+            if key not in self.items:
+                return False
+            self.items[key] = self.items.pop(key)
+            return True
+
+    def add(self, key):
+        with self.lock:
+            self.items.pop(key, None)
+            self.items[key] = True
+            if len(self.items) > self.size:
+                self.items.popitem(last=False)
+
+    def discard(self, key):
+        with self.lock:
+            self.items.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.items.clear()
+
+known_resources = KnownResources()
+
+
+def is_known(model, pk, transport=None):
+    """ Return True if the resource is known to exist on the API of the transport. """
+    transport = transport or default_transport
+    return (transport.api_url, model, pk) in known_resources
+
+
+def set_known(model, pk, known=True, transport=None):
+    """ Mark a resource as existing (or not) on the API of the transport. """
+    if model == "history":
+        # History entries are only posted once, with a new uuid
+        return
+    transport = transport or default_transport
+    if known:
+        known_resources.add((transport.api_url, model, pk))
+    else:
+        known_resources.discard((transport.api_url, model, pk))
+
+
+def is_duplicate(status_code, resp):
+    """ Return True if the API rejected a POST because the resource already exists
+    (409 Conflict, or an unique validation issue). """
+    if status_code == 409:
+        return True
+    if resp and resp.get("status") == "ERR":
+        return any("unique" in str(issue) for issue in resp.get("issues", []))
+    return False
+
+
+def history_key(history):
+    """ Return the (ts, seq, uuid) ordering a History entry (or a pull cursor). """
+    return history["ts"], history.get("seq", 0), history["uuid"]
+
+
+def history_after(model, key):
+    """ Eve where of the History entries of a model ordered after a (ts, seq, uuid). """
+    ts, seq, uuid = key
+    return {"model": model,
+            "$or": [{"ts": {"$gt": ts}},
+                    {"ts": ts, "seq": {"$gt": seq}},
+                    {"ts": ts, "seq": seq, "uuid": {"$gt": uuid}}]}
+
+
+def iter_remote_history(model, cursor=0, page_size=50, overlap=0, transport=None):
+    """ Fetch the remote history over the API from the pull cursor, page by page.
+
+    The first page starts overlap seconds before the cursor, since other clients
+    stamp their entries before posting them. The next pages start right after the
+    last entry received, so the entries posted meanwhile can't shift them.
 
+    :type cursor: dict
+    :param cursor: Pull cursor, the (ts, seq, uuid) of the last entry applied (or a timestamp).
 
-def get_remote_history(model, last_sync=0):
-    """ Fetch the remote history over the API since last sync. """
-    log.info("Fetching remote history since {0}".format(last_sync))
-    if last_sync:
-        from .model import SYNC_BUFFER
-        last_sync -= SYNC_BUFFER
-    r = requests.get(api_root('history'),
-                     params={"where": json.dumps({"ts": {"$gte": last_sync},
-                                                  "model": model}),
-                             "sort": json.dumps({"ts": 1})})
+    :return: Generator of pages (list of history entries).
+
+    """
+    transport = transport or default_transport
+    ts = cursor["ts"] if isinstance(cursor, dict) else cursor
+    log.info("Fetching remote history since %s", ts)
+    where = {"ts": {"$gte": ts - overlap}, "model": model}
+    params = {"sort": HISTORY_SORT,
+              "max_results": page_size}
+    while True:
+        params["where"] = json.dumps(where)
+        r = transport.get(transport.root('history'), params=params)
+        r.raise_for_status()
+        resp = transport.decode(r)
+        items = resp.get("_items", [])
+        yield items
+        if not items or not resp.get("_links", {}).get("next"):
+            break
+        where = history_after(model, max(history_key(h) for h in items))
+
+
+def poll_remote_history(cursors, page_size=50, wait=30, transport=None):
+    """ Long-poll the remote History of several models at once.
+
+    The API holds the request until entries are available or wait seconds
+    have elapsed (APIs without long-poll ignore the wait parameter and reply right away).
+
+    :type cursors: dict
+    :param cursors: Pull cursor of each model name, only the entries after it are returned
+        (the entries posted late behind it are left to the overlap of the next pull).
+
+    :return: List of history entries, sorted by (ts, seq, uuid).
+
+    """
+    transport = transport or default_transport
+    where = {"$or": [history_after(model, history_key(cursor))
+                     for model, cursor in sorted(cursors.items())]}
+    params = {"where": json.dumps(where),
+              "sort": HISTORY_SORT,
+              "max_results": page_size,
+              "wait": wait}
+    r = transport.get(transport.root('history'), params=params, timeout=wait + POLL_TIMEOUT_MARGIN)
+    r.raise_for_status()
+    return transport.decode(r).get("_items", [])
+
+
+def get_last_remote_history(model, transport=None):
+    """ Fetch the latest remote History entry of a model, None if there is none. """
+    transport = transport or default_transport
+    params = {"where": json.dumps({"model": model}),
+              "sort": json.dumps([["ts", -1], ["seq", -1], ["uuid", -1]]),
+              "max_results": 1}
+    r = transport.get(transport.root('history'), params=params)
     r.raise_for_status()
-    return r.json().get("_items", [])
+    items = transport.decode(r).get("_items", [])
+    return items[0] if items else None
 
 
-def delete_resource(model, pk, etag, raw_history=None):
-    """ Delete a resource. """
+def get_remote_history(model, last_sync=0, transport=None):
+    """ Fetch the remote history over the API since last sync (see iter_remote_history). """
+    return [history for page in iter_remote_history(model, last_sync, transport=transport)
+            for history in page]
+
+
+def history_payload(raw_history):
+    """ Prepare a local History entry for being posted to the API. """
+    raw_history = dict(raw_history)
+    # Since we can't rely on autoincrement id, we use uuid
+    raw_history.pop("id", None)
+    # Local sync state
+    raw_history.pop("is_synced", None)
+    raw_history.pop("is_applied", None)
+    raw_history.pop("attempts", None)
+    raw_history.pop("retry_at", None)
+    # Data is sent as a nested document, not as a JSON string
+    raw_history["data"] = document(raw_history.get("data") or {})
+    raw_history["uuid"] = str(raw_history.get("uuid"))
+    # We also update the timestamp, so it is after the entries already pulled
+    raw_history["ts"], raw_history["seq"] = clock.now()
+    return raw_history
+
+
+def delete_resource(model, pk, etag, raw_history=None, push_history=True, transport=None):
+    """ Delete a resource.
+
+    If push_history is False, the caller is responsible
+    for posting the History entry (see post_history).
+
+    """
+    transport = transport or default_transport
     if etag:
-        log.info("Deleting resource {0} {1} (etag={2}, history={3}".format(model, pk, etag, raw_history))
-        r = requests.delete(api_resource(model, pk),
-                            headers={"If-Match": etag})
+        log.info("Deleting resource %s %s (etag=%s, history=%s", model, pk, etag, raw_history)
+        r = transport.delete(transport.resource(model, pk),
+                             headers={"If-Match": etag})
         r.raise_for_status()
+        set_known(model, pk, False, transport=transport)
 
-        del raw_history["id"]
-        raw_history["ts"] = int(datetime.utcnow().strftime("%s"))
-        post_resource("history", raw_history.get("uuid"), json.dumps(raw_history))
+        if push_history and raw_history is not None:
+            post_resource("history", raw_history.get("uuid"), history_payload(raw_history),
+                          optimistic=True, transport=transport)
         return True
     return False
 
 
-def patch_resource(model, pk, update, etag, raw_history=None):
-    """ Patch a resource. """
-    log.info("Patching {0} {1}: {2} (etag={3}, history={4}".format(model, pk, update, etag, raw_history))
+def patch_resource(model, pk, update, etag, raw_history=None, push_history=True, transport=None):
+    """ Patch a resource.
+
+    If push_history is False, the caller is responsible
+    for posting the History entry (see post_history).
+
+    """
+    transport = transport or default_transport
+    log.info("Patching %s %s: %s (etag=%s, history=%s", model, pk, update, etag, raw_history)
     payload = {"data": update}
-    r = requests.patch(api_resource(model, pk),
-                       payload,
-                       headers={"If-Match": etag})
+    r = transport.patch(transport.resource(model, pk),
+                        payload,
+                        headers={"If-Match": etag})
     r.raise_for_status()
-    resp = r.json().get("data")
+    resp = transport.decode(r).get("data")
     log.info(resp)
     if resp.get("status") == "OK":
         if model != "history" and raw_history is not None:
-            # Call post_resource itself for the history
-            del raw_history["id"]  # Since we can't rely on autoincrement id, we use uuid
-            # We also update the timestamp (ts)
-            raw_history["ts"] = int(datetime.utcnow().strftime("%s"))
-
-            # The model is patched, so now we need to post this history entry to the API
-            post_resource("history", raw_history.get("uuid"), json.dumps(raw_history))
+            if push_history:
+                # The model is patched, so now we need to post this history entry to the API
+                post_resource("history", raw_history.get("uuid"), history_payload(raw_history),
+                              optimistic=True, transport=transport)
 
             return resp.get("etag")
 
@@ -69,52 +247,249 @@ def patch_resource(model, pk, update, etag, raw_history=None):
         log.error("Issue patching {0}: {1}".format(payload, resp))
 
 
-def post_resource(model, pk, data, raw_history=None):
+def post_resource(model, pk, data, raw_history=None, optimistic=False, push_history=True, transport=None):
     """ Create a resource, but verify if it doesn't exist yet before.
     Also used to POST history to the API.
 
+    If push_history is False, the caller is responsible
+    for posting the History entry (see post_history).
+
+    If optimistic is True, the existence check is skipped and a
+    duplicate error returned by the API means the resource already exists,
+    only use it if the API enforces uniqueness of the primary key.
+    History entries are always posted optimistically since they use uuid.
+
+    Resources already known to exist are never posted again.
+
     :return: resource ETag if successful, None if any error.
 
     """
-    call_url = api_resource(model, pk)
-    r = requests.get(call_url)
-    if r.status_code == 404:
-        log.info("Posting {0} {1}: {2} (history={3}".format(model, pk, data, raw_history))
-        payload = {"item": data}
-        r = requests.post(api_root(model),
-                          payload)
-        #try:
+    transport = transport or default_transport
+    if is_known(model, pk, transport=transport):
+        log.debug("%s %s already exists", model, pk)
+        return
+    if not optimistic:
+        r = transport.get(transport.resource(model, pk))
+        if r.status_code == 200:
+            set_known(model, pk, transport=transport)
+            return
+        elif r.status_code != 404:
+            # Not cached, the existence is checked again on the next push
+            r.raise_for_status()
+            return
+
+    log.info("Posting %s %s: %s (history=%s", model, pk, data, raw_history)
+    payload = {"item": data}
+    r = transport.post(transport.root(model),
+                       payload)
+    resp = None
+    if r.status_code != 409:
         r.raise_for_status()
-        resp = r.json().get("item")
+        resp = transport.decode(r).get("item")
         log.info(resp)
-        if resp.get("status") == "OK":
-            if model != "history" and raw_history is not None:
-                etag = resp.get("etag")
-                # Call post_resource itself for the history
-                del raw_history["id"]  # Since we can't rely on autoincrement id, we use uuid
-                # We also update the timestamp (ts)
-                raw_history["ts"] = int(datetime.utcnow().strftime("%s"))
-                post_resource("history", raw_history.get("uuid"), json.dumps(raw_history))
-                return etag
-        elif resp.get("status") == "ERR":
-            log.error("Issue posting: {0}".format(payload))
-            for issue in resp["issues"]:
-                log.error(issue)
-        elif resp.get("status") != "OK":
-            log.error("Issue posting {0}: {1}".format(payload, resp))
-
-
-def get_resource(model, pk):
+    if is_duplicate(r.status_code, resp):
+        log.debug("%s %s already exists", model, pk)
+        set_known(model, pk, transport=transport)
+    elif resp.get("status") == "OK":
+        set_known(model, pk, transport=transport)
+        if push_history and model != "history" and raw_history is not None:
+            # Call post_resource itself for the history
+            post_resource("history", raw_history.get("uuid"), history_payload(raw_history),
+                          optimistic=True, transport=transport)
+        return resp.get("etag")
+    elif resp.get("status") == "ERR":
+        log.error("Issue posting: {0}".format(payload))
+        for issue in resp["issues"]:
+            log.error(issue)
+    else:
+        log.error("Issue posting {0}: {1}".format(payload, resp))
+
+
+def post_resources(model, items, transport=None):
+    """ Create several resources with a single bulk POST,
+    each item is sent as its own form field (item0, item1...).
+
+    Unlike post_resource, no existence check is performed,
+    an already existing resource is reported as an error by the API.
+
+    :type items: list
+    :param items: List of (pk, JSON encoded resource).
+
+    :return: List of ETags in the same order as items,
+        None for each item that failed.
+
+    """
+    return [etag for etag, duplicate in _post_items(model, items, transport)]
+
+
+def _post_items(model, items, transport=None):
+    """ Bulk POST of several resources (see post_resources).
+
+    :return: List of (ETag, already existing) in the same order as items.
+
+    """
+    transport = transport or default_transport
+    if not items:
+        return []
+    log.info("Bulk posting %s %s", len(items), model)
+    payload = dict(("item{0}".format(i), data) for i, (pk, data) in enumerate(items))
+    r = transport.post(transport.root(model), payload)
+    r.raise_for_status()
+    resp = transport.decode(r)
+    results = []
+    for i, (pk, data) in enumerate(items):
+        item = resp.get("item{0}".format(i), {})
+        if item.get("status") == "OK":
+            set_known(model, pk, transport=transport)
+            results.append((item.get("etag"), False))
+        elif is_duplicate(r.status_code, item):
+            log.debug("%s %s already exists", model, pk)
+            set_known(model, pk, transport=transport)
+            results.append((None, True))
+        else:
+            log.error("Issue posting {0}: {1}".format(data, item))
+            results.append((None, False))
+    return results
+
+
+def post_history(raw_histories, transport=None):
+    """ Post several local History entries with a single bulk POST.
+
+    :return: List of booleans, True for each entry stored by the API
+        (already existing ones included).
+
+    """
+    results = _post_items("history", [(h.get("uuid"), history_payload(h)) for h in raw_histories],
+                          transport=transport)
+    return [bool(etag) or duplicate for etag, duplicate in results]
+
+
+def get_resource(model, pk, transport=None):
     """ Perform a GET request over a resource. """
-    log.info("GET {0} {1}".format(model, pk))
-    call_url = api_resource(model, pk)
-    r = requests.get(call_url)
+    transport = transport or default_transport
+    log.info("GET %s %s", model, pk)
+    r = transport.get(transport.resource(model, pk))
     if r.status_code == 200:
         r.raise_for_status()
-        data = r.json()
-        if "_id" in data:
-            del data["_id"]
-            del data["_links"]
-            del data["created"]
-            del data["updated"]
-        return data
+        set_known(model, pk, transport=transport)
+        return clean_resource(transport.decode(r))
+
+
+def clean_resource(data):
+    """ Remove the Eve meta fields from a resource. """
+    if "_id" in data:
+        del data["_id"]
+        del data["_links"]
+        del data["created"]
+        del data["updated"]
+    return data
+
+
+def get_resources(model, pks, pk_field="uuid", where=None, transport=None):
+    """ Fetch several resources, with a query per MAX_PKS_PER_QUERY pks
+    (following the Eve pagination).
+
+    :type pk_field: str
+    :param pk_field: Name of the primary key field of the model.
+
+    :type where: dict
+    :param where: Additional Eve where, only the matching resources are returned.
+
+    :return: dict pk => resource, missing resources are not included.
+
+    """
+    transport = transport or default_transport
+    pks = list(set(pks))
+    if not pks:
+        return {}
+    log.info("GET %s %s resources", model, len(pks))
+    resources = {}
+    for i in range(0, len(pks), MAX_PKS_PER_QUERY):
+        chunk = pks[i:i + MAX_PKS_PER_QUERY]
+        chunk_where = dict(where or {})
+        chunk_where[pk_field] = {"$in": chunk}
+        params = {"where": json.dumps(chunk_where),
+                  "max_results": min(len(chunk), MAX_RESULTS)}
+        page = 1
+        while True:
+            params["page"] = page
+            r = transport.get(transport.root(model), params=params)
+            r.raise_for_status()
+            resp = transport.decode(r)
+            for data in resp.get("_items", []):
+                data = clean_resource(data)
+                set_known(model, data[pk_field], transport=transport)
+                resources[data[pk_field]] = data
+            if not resp.get("_links", {}).get("next"):
+                break
+            page += 1
+    return resources
+
+
+def iter_resources(model, pk_field="uuid", page_size=50, where=None, transport=None):
+    """ Fetch the whole resource collection, page by page, following the Eve pagination.
+
+    :type where: dict
+    :param where: Eve where, only the matching resources are returned.
+
+    :return: Generator of pages (list of resources).
+
+    """
+    transport = transport or default_transport
+    log.info("Fetching all %s resources", model)
+    params = {"sort": json.dumps({pk_field: 1}),
+              "max_results": page_size}
+    if where:
+        params["where"] = json.dumps(where)
+    page = 1
+    while True:
+        params["page"] = page
+        r = transport.get(transport.root(model), params=params)
+        r.raise_for_status()
+        resp = transport.decode(r)
+        resources = [clean_resource(data) for data in resp.get("_items", [])]
+        for data in resources:
+            set_known(model, data[pk_field], transport=transport)
+        yield resources
+        if not resp.get("_links", {}).get("next"):
+            break
+        page += 1
+
+
+class RemoteMerkleTree(object):
+    """ Hash tree of a resource collection, computed by the API (see merkle.MerkleTree).
+
+    The API must serve GET <api>/_merkle/<model>/ with the depth, where and prefixes
+    (JSON list) parameters, returning {"hashes": {prefix: hash}}, and with the leaves
+    parameter instead of prefixes, returning {"_items": [[pk, etag], ...]}
+    (see local_api.LocalApi). Otherwise, requests fail with a 404.
+
+    """
+    # Max number of prefixes per request, to keep the url short
+    max_prefixes = 256
+
+    def __init__(self, model, depth, where=None, transport=None):
+        self.model = model
+        self.depth = depth
+        self.where = where
+        self.transport = transport or default_transport
+
+    def _get(self, key, values):
+        params = {"depth": self.depth, key: json.dumps(values)}
+        if self.where:
+            params["where"] = json.dumps(self.where)
+        r = self.transport.get(self.transport.resource("_merkle", self.model), params=params)
+        r.raise_for_status()
+        return self.transport.decode(r)
+
+    def hash_many(self, prefixes):
+        hashes = {}
+        for i in range(0, len(prefixes), self.max_prefixes):
+            hashes.update(self._get("prefixes", prefixes[i:i + self.max_prefixes])["hashes"])
+        return hashes
+
+    def items(self, leaves):
+        items = []
+        for i in range(0, len(leaves), self.max_prefixes):
+            items.extend(tuple(item) for item in self._get("leaves", leaves[i:i + self.max_prefixes])["_items"])
+        return items
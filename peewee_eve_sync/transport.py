@@ -0,0 +1,239 @@
+# encoding: utf-8
+import requests
+from requests.adapters import BaseAdapter, HTTPAdapter
+from requests.structures import CaseInsensitiveDict
+import logging
+import threading
+import time
+import urllib
+
+from metrics import metrics
+import encoding
+
+log = logging.getLogger(__name__)
+
+
+class CircuitOpen(requests.ConnectionError):
+    """ Raised instead of calling the API while the circuit breaker is open. """
+
+
+class CircuitBreaker(object):
+    """ Stop calling the API after several consecutive failures.
+
+    Once threshold failures (connection errors or 5xx responses) happened in a row,
+    the circuit is open and calls fail right away with CircuitOpen. After reset_timeout
+    seconds, a single call is allowed through: the circuit is closed again if it succeeds.
+
+    :type threshold: int
+    :param threshold: Number of consecutive failures opening the circuit.
+
+    :type reset_timeout: float
+    :param reset_timeout: Seconds to wait before trying to call the API again.
+
+    """
+    def __init__(self, threshold=5, reset_timeout=30):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.lock = threading.Lock()
+
+    @property
+    def is_open(self):
+        return self.opened_at is not None
+
+    def allow(self):
+        """ Return True if the API can be called. """
+        with self.lock:
+            if self.opened_at is None:
+                return True
+            if time.time() >= self.opened_at + self.reset_timeout:
+                # Half-open: let this call through, and block the others until it completes
+                self.opened_at = time.time()
+                return True
+            return False
+
+    def success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+
+    def failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.failures >= self.threshold:
+                if self.opened_at is None:
+                    log.warning("API unavailable, calls suspended for {0}s".format(self.reset_timeout))
+                self.opened_at = time.time()
+
+
+class Transport(object):
+    """ HTTP transport used to talk to the Eve API.
+
+    All the calls go through a shared requests.Session,
+    so connections are pooled and kept alive between calls.
+
+    :type api_url: str
+    :param api_url: API root url, with trailing slash.
+
+    :type pool_size: int
+    :param pool_size: Number of connections kept alive per host.
+
+    :type timeout: float
+    :param timeout: Timeout in seconds for each call, None to wait forever.
+
+    :type gzip: bool
+    :param gzip: Ask for compressed responses.
+
+    :type breaker: CircuitBreaker
+    :param breaker: Circuit breaker used to stop calling a failing API, a default one if None.
+
+    :type body_encoding: str
+    :param body_encoding: Encoding of the request bodies, "form" (one JSON encoded form field
+                          per document, understood by any Eve API), "json" or "msgpack".
+                          With "msgpack", msgpack responses are also accepted.
+
+    :type compress: bool
+    :param compress: gzip the request bodies larger than compress_min_size bytes,
+                     the API must support Content-Encoding: gzip.
+
+    """
+    def __init__(self, api_url="http://localhost/api/", pool_size=10,
+                 timeout=None, gzip=True, max_retries=0, breaker=None,
+                 body_encoding="form", compress=False, compress_min_size=1024):
+        self.api_url = api_url
+        self.timeout = timeout
+        self.breaker = breaker or CircuitBreaker()
+        if body_encoding == "msgpack" and encoding.msgpack is None:
+            log.warning("msgpack is not installed, JSON is used instead")
+            body_encoding = "json"
+        self.body_encoding = body_encoding
+        self.compress = compress
+        self.compress_min_size = compress_min_size
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size,
+                              pool_maxsize=pool_size,
+                              max_retries=max_retries)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.session.headers["Accept-Encoding"] = "gzip, deflate" if gzip else "identity"
+        if body_encoding == "msgpack":
+            self.session.headers["Accept"] = "{0}, {1}".format(encoding.MSGPACK, encoding.JSON)
+        else:
+            self.session.headers["Accept"] = encoding.JSON
+
+    def root(self, model):
+        """ Url of a resource collection. """
+        return "{0}{1}/".format(self.api_url, model)
+
+    def resource(self, model, pk):
+        """ Url of a single resource. """
+        return "{0}{1}/{2}/".format(self.api_url, model, pk)
+
+    def request(self, method, url, **kwargs):
+        if not self.breaker.allow():
+            raise CircuitOpen("API unavailable, {0} {1} not performed".format(method, url))
+        kwargs.setdefault("timeout", self.timeout)
+        start = time.time()
+        try:
+            r = self.session.request(method, url, **kwargs)
+        except (requests.ConnectionError, requests.Timeout):
+            self.breaker.failure()
+            metrics.incr("http.errors")
+            raise
+        metrics.observe("http.latency", time.time() - start)
+        metrics.incr("http." + method.lower())
+        if isinstance(r.request.body, basestring):
+            metrics.incr("http.bytes_sent", len(r.request.body))
+        metrics.incr("http.bytes_received", len(r.content))
+        if r.status_code == 412:
+            metrics.incr("http.conflicts")
+        if r.status_code >= 500:
+            self.breaker.failure()
+        else:
+            self.breaker.success()
+        return r
+
+    def encode(self, payload):
+        """ Encode a request payload, a dict of documents.
+
+        :return: (body, headers)
+
+        """
+        if self.body_encoding == "form":
+            content_type = "application/x-www-form-urlencoded"
+            fields = [(k, v if isinstance(v, basestring) else encoding.dumps(v)) for k, v in payload.items()]
+            body = urllib.urlencode([(k, v.encode("utf-8") if isinstance(v, unicode) else v)
+                                     for k, v in fields])
+        else:
+            content_type = encoding.MSGPACK if self.body_encoding == "msgpack" else encoding.JSON
+            body = encoding.pack(dict((k, encoding.document(v)) for k, v in payload.items()),
+                                 content_type)
+        headers = {"Content-Type": content_type}
+        if self.compress and len(body) >= self.compress_min_size:
+            body = encoding.compress(body)
+            headers["Content-Encoding"] = "gzip"
+        return body, headers
+
+    def decode(self, r):
+        """ Decode a response body, according to its Content-Type. """
+        return encoding.unpack(r.content, r.headers.get("Content-Type", encoding.JSON))
+
+    def get(self, url, params=None, **kwargs):
+        return self.request("GET", url, params=params, **kwargs)
+
+    def post(self, url, payload=None, **kwargs):
+        return self.send_payload("POST", url, payload, **kwargs)
+
+    def patch(self, url, payload=None, **kwargs):
+        return self.send_payload("PATCH", url, payload, **kwargs)
+
+    def send_payload(self, method, url, payload, headers=None, **kwargs):
+        body, payload_headers = self.encode(payload or {})
+        payload_headers.update(headers or {})
+        return self.request(method, url, data=body, headers=payload_headers, **kwargs)
+
+    def delete(self, url, **kwargs):
+        return self.request("DELETE", url, **kwargs)
+
+    def close(self):
+        """ Close all the pooled connections. """
+        self.session.close()
+
+
+class LocalAdapter(BaseAdapter):
+    """ requests adapter calling an in-process app instead of the network.
+
+    The app is a callable taking a requests.PreparedRequest
+    and returning a (status_code, headers, body) tuple.
+
+    """
+    def __init__(self, app):
+        super(LocalAdapter, self).__init__()
+        self.app = app
+
+    def send(self, request, **kwargs):
+        status_code, headers, body = self.app(request)
+        response = requests.Response()
+        response.status_code = status_code
+        response.headers = CaseInsensitiveDict(headers or {})
+        response._content = body
+        response.url = request.url
+        response.request = request
+        response.encoding = "utf-8"
+        return response
+
+    def close(self):
+        pass
+
+
+class LocalTransport(Transport):
+    """ Transport serving all the calls from an in-process app
+    (see LocalAdapter), useful for testing or benchmarking without the network. """
+    def __init__(self, app, api_url="http://localhost/api/", **kwargs):
+        super(LocalTransport, self).__init__(api_url, **kwargs)
+        self.app = app
+        self.session.mount(api_url, LocalAdapter(app))
+
+
+default_transport = Transport()
@@ -0,0 +1,148 @@
+# encoding: utf-8
+import logging
+import threading
+import time
+
+from engine import SyncEngine
+
+log = logging.getLogger(__name__)
+
+
+class SyncWorker(object):
+    """ Background thread syncing models, used for auto sync
+    instead of syncing in select/get/save/delete_instance.
+
+    Triggers are debounced and coalesced: models are synced once no trigger
+    happened for debounce seconds, or right away after max_writes writes.
+    All the models are also synced every interval seconds.
+    Like for SyncEngine, the database must share a single connection between
+    threads (threadlocals=False, check_same_thread=False).
+
+    :type models: list
+    :param models: Models synced on interval, all the SyncedModel subclasses by default.
+
+    :type interval: float
+    :param interval: Seconds between two full syncs, None to only sync on triggers.
+
+    :type debounce: float
+    :param debounce: Seconds to wait for other triggers before syncing.
+
+    :type max_writes: int
+    :param max_writes: Number of writes after which models are synced without waiting.
+
+    """
+    def __init__(self, models=None, interval=60, debounce=1, max_writes=100,
+                 concurrency=4, debug=False):
+        self.engine = SyncEngine(models, concurrency, debug)
+        self.interval = interval
+        self.debounce = debounce
+        self.max_writes = max_writes
+        self.cond = threading.Condition()
+        self.pending = set()
+        self.writes = 0
+        self.last_trigger = None
+        self.last_sync = time.time()
+        # flush requests, and the last one fulfilled
+        self.requested = 0
+        self.completed = 0
+        self.running = False
+        self.thread = None
+        self.last_stats = None
+
+    def start(self):
+        with self.cond:
+            if self.thread is not None:
+                return
+            self.running = True
+            self.thread = threading.Thread(target=self.run, name="peewee-eve-sync")
+            self.thread.daemon = True
+            self.thread.start()
+
+    def trigger(self, model, write=False):
+        """ Schedule the sync of a model, never blocks. """
+        with self.cond:
+            self.pending.add(model)
+            self.last_trigger = time.time()
+            if write:
+                self.writes += 1
+            self.cond.notify_all()
+
+    def flush(self, timeout=None):
+        """ Sync right away and wait for it to complete.
+
+        :return: False if the timeout expired before the end of the sync.
+
+        """
+        deadline = timeout is not None and time.time() + timeout
+        with self.cond:
+            self.requested += 1
+            target = self.requested
+            self.cond.notify_all()
+            while self.completed < target and self.running:
+                if deadline:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        break
+                    self.cond.wait(remaining)
+                else:
+                    self.cond.wait()
+            return self.completed >= target
+
+    def stop(self, flush=True, timeout=None):
+        """ Stop the worker, after a last sync if flush is True. """
+        if self.thread is None:
+            return
+        if flush:
+            self.flush(timeout)
+        with self.cond:
+            self.running = False
+            self.cond.notify_all()
+        self.thread.join(timeout)
+        self.thread = None
+
+    def _next_sync(self):
+        """ Return the number of seconds to wait before the next sync,
+        0 to sync now, None to wait for a trigger. """
+        now = time.time()
+        if self.requested > self.completed:
+            return 0
+        if self.pending and self.writes >= self.max_writes:
+            return 0
+        delays = []
+        if self.pending:
+            delays.append(self.last_trigger + self.debounce - now)
+        if self.interval is not None:
+            delays.append(self.last_sync + self.interval - now)
+        if not delays:
+            return None
+        return max(0, min(delays))
+
+    def run(self):
+        while True:
+            with self.cond:
+                while self.running:
+                    delay = self._next_sync()
+                    if delay == 0:
+                        break
+                    self.cond.wait(delay)
+                if not self.running:
+                    return
+                generation = self.requested
+                full_sync = (self.requested > self.completed or not self.pending or
+                             self.interval is not None and time.time() >= self.last_sync + self.interval)
+                models = set(self.pending)
+                if full_sync:
+                    models.update(self.engine.get_models())
+                self.pending.clear()
+                self.writes = 0
+
+            try:
+                self.last_stats = self.engine.sync(list(models))
+            except Exception, exc:
+                log.error("Error in sync worker")
+                log.exception(exc)
+
+            with self.cond:
+                self.last_sync = time.time()
+                self.completed = max(self.completed, generation)
+                self.cond.notify_all()
@@ -3,11 +3,29 @@
 """ test_peewee_eve_sync.py - Test the peewee_eve_sync module. """
 
 import unittest
+import json
 import time
+import threading
+import urlparse
+import os
+import shutil
+import tempfile
+from uuid import uuid4
 from sure import expect
 import peewee
 import requests
-from peewee_eve_sync.model import History, SyncedModel, KeyValue, SyncSettings
+from peewee_eve_sync.model import (get_ts, migrate_sync_state, etags, get_etag,
+                                   History, SyncedModel, KeyValue, ETag, SeenHistory,
+                                   SyncSettings, seen_history, SyncDatabase, WAL_PRAGMAS,
+                                   init_meta_database, Lease, SYNC_BUFFER)
+from peewee_eve_sync import remote, encoding, model as sync_model
+from peewee_eve_sync.clock import HybridClock, clock
+from peewee_eve_sync.transport import LocalTransport, CircuitBreaker, CircuitOpen
+from peewee_eve_sync.local_api import LocalApi, match
+from peewee_eve_sync.metrics import metrics, InstrumentedSqliteDatabase
+from peewee_eve_sync.engine import SyncEngine
+from peewee_eve_sync.worker import SyncWorker
+from peewee_eve_sync.feed import SyncFeed
 from playhouse.test_utils import test_database
 from eve_mocker import EveMocker
 from httpretty import HTTPretty
@@ -35,14 +53,31 @@ class TestModel(SyncedModel):
         pk = "key"
 
 
+class TestNote(SyncedModel):
+    uuid = peewee.CharField(default=lambda: str(uuid4()))
+    content = peewee.CharField()
+    name = peewee.CharField(default="")
+
+
 class TestPeeweeEveSync(unittest.TestCase):
     def setUp(self):
         self.dbs = {}
         for idb in range(NB_CLIENTS):
             self.dbs[idb] = peewee.SqliteDatabase(":memory:")
 
-        self.models = (TestModel, History, KeyValue)
+        self.models = (TestModel, History, KeyValue, ETag, SeenHistory, Lease)
+        TestModel.Sync.auto = False
+        TestModel.Sync.batch_size = 1
+        TestModel.Sync.optimistic_create = False
+        TestModel.Sync.worker = None
+        TestModel.Sync.transport = SyncSettings.transport
+        TestModel.Sync.page_size = SyncSettings.page_size
+        TestModel.Sync.filter = None
+        TestModel.Sync.lease_ttl = SyncSettings.lease_ttl
+        remote.known_resources.clear()
+        clock.last = (0, 0)
 
+        HTTPretty.reset()
         HTTPretty.enable()
         self.eve_mocker = EveMocker("http://localhost/api/", pk_maps={"testmodel": "key"}, default_pk="uuid")
 
@@ -79,6 +114,11 @@ class TestPeeweeEveSync(unittest.TestCase):
             out.append(_d)
         return sorted(out, key=lambda x: x["key"])
 
+    def _requests(self, method, path):
+        """ Return the recorded requests matching the given method and path. """
+        return [r for r in HTTPretty.latest_requests
+                if r.method == method and r.path.startswith(path)]
+
     def testSynchronizationAuto(self):
         """ Setup a few models, and try to sync them between 3 sqlite databases. """
         # First, we create nb_items on db0
@@ -145,5 +185,1019 @@ class TestPeeweeEveSync(unittest.TestCase):
         # TODO faire le tout delete et checker empty
         # TODO remove le Item doesn't exists
 
+    def testBatchPush(self):
+        """ Push with bulk requests and check everything is propagated. """
+        TestModel.Sync.batch_size = 5
+        with test_database(self.dbs[0], self.models, create_tables=False):
+            self._createTables()
+            HTTPretty.latest_requests = []
+            for item in self.items:
+                TestModel.create(**item)
+            TestModel.sync()
+            cmodel = TestModel._get(TestModel.key == "ok0")
+            cmodel.content = "new content0"
+            cmodel.save()
+            TestModel._get(TestModel.key == "ok1").delete_instance()
+            TestModel.sync()
+
+        # Creates are sent by 5, and History entries too
+        len(self._requests("POST", "/api/testmodel/")).should.be.equal(NB_ITEMS / 5)
+        len(self._requests("POST", "/api/history/")).should.be.equal(NB_ITEMS / 5 + 1)
+
+        expected = [dict(item) for item in self.items if item["key"] != "ok1"]
+        expected[0]["content"] = "new content0"
+        _items = requests.get("http://localhost/api/testmodel/").json().get("_items", [])
+        self._rawEntries(_items).should.be.equal(expected)
+        _history = requests.get("http://localhost/api/history/").json().get("_items", [])
+        len(_history).should.be.equal(NB_ITEMS + 2)
+
+    def testHistoryCompaction(self):
+        """ History chains are folded before push, and synced History is pruned. """
+        with test_database(self.dbs[0], self.models, create_tables=False):
+            self._createTables()
+            for item in self.items[:3]:
+                TestModel.create(**item)
+            for i in range(5):
+                cmodel = TestModel._get(TestModel.key == "ok0")
+                cmodel.content = "content{0}".format(i)
+                cmodel.save()
+            TestModel._get(TestModel.key == "ok1").delete_instance()
+            HTTPretty.latest_requests = []
+            TestModel.sync_push().should.be.equal(2)
+
+            # ok0 is created with its last content, ok1 is never posted
+            self._requests("PATCH", "/api/").should.be.empty
+            self._requests("DELETE", "/api/").should.be.empty
+            _items = requests.get("http://localhost/api/testmodel/").json().get("_items", [])
+            self._rawEntries(_items).should.be.equal([{"key": "ok0", "content": "content4"},
+                                                      self.items[2]])
+            History.select().count().should.be.equal(2)
+
+            History.update(ts=get_ts() - TestModel.Sync.history_retention - 1).execute()
+            TestModel.sync_push().should.be.equal(0)
+            History.select().count().should.be.equal(0)
+
+    def testOptimisticCreate(self):
+        """ Creates are posted without existence check, duplicates are ignored. """
+        TestModel.Sync.optimistic_create = True
+        with test_database(self.dbs[0], self.models, create_tables=False):
+            self._createTables()
+            for item in self.items:
+                TestModel.create(**item)
+            HTTPretty.latest_requests = []
+            TestModel.sync()
+
+        # Only the pull hits the API with a GET
+        len(self._requests("GET", "/api/")).should.be.equal(1)
+        _items = requests.get("http://localhost/api/testmodel/").json().get("_items", [])
+        self._rawEntries(_items).should.be.equal(self.items)
+
+        # The same item created on another client is rejected, and not posted again
+        remote.known_resources.clear()
+        with test_database(self.dbs[1], self.models, create_tables=False):
+            self._createTables()
+            TestModel._create(**self.items[0])
+            History.create(data=json.dumps(self.items[0]), ts=get_ts(),
+                           action="create", model="testmodel", pk="ok0")
+            TestModel.sync_push()
+            remote.is_known("testmodel", "ok0").should.be.true
+            # The ETag of the existing resource is stored, for the next updates
+            get_etag("testmodel", "ok0").should.be.equal(
+                requests.get("http://localhost/api/testmodel/ok0/").json()["etag"])
+            History.pending("testmodel").count().should.be.equal(0)
+            remote.is_known("history", History.get().uuid).should.be.false
+            HTTPretty.latest_requests = []
+            TestModel.sync_push()
+            self._requests("POST", "/api/").should.be.empty
+
+        # Resources are known per API, and only the most recent ones are kept
+        other = LocalTransport(LocalApi(), api_url="http://example.com/api/")
+        remote.is_known("testmodel", "ok0", transport=other).should.be.false
+        known = remote.KnownResources(size=2)
+        for key in ("a", "b", "a", "c"):
+            known.add(key)
+        ("a" in known, "b" in known, "c" in known).should.be.equal((True, False, True))
+
+        # A failed existence check is not cached, the create is posted by the next push
+        remote.known_resources.clear()
+        api = LocalApi(pk_maps={"testmodel": "key"})
+        get_down = [True]
+
+        def app(request):
+            if request.method == "GET" and "/testmodel/" in request.url and get_down[0]:
+                return 500, {}, "{}"
+            return api(request)
+        TestModel.Sync.transport = LocalTransport(app, breaker=CircuitBreaker(threshold=100))
+        TestModel.Sync.optimistic_create = False
+        with test_database(self.dbs[0], self.models, create_tables=False):
+            self._createTables()
+            TestModel.create(**self.items[0])
+            TestModel.sync_push().should.be.equal(0)
+            remote.is_known("testmodel", "ok0", transport=TestModel.Sync.transport).should.be.false
+            get_down[0] = False
+            History.update(retry_at=0).execute()
+            TestModel.sync_push().should.be.equal(1)
+            api.resources["testmodel"].keys().should.be.equal(["ok0"])
+
+    def testETagStore(self):
+        """ ETags are cached, and written through to the ETag table. """
+        with test_database(self.dbs[0], self.models, create_tables=False):
+            self._createTables()
+            etags.set("testmodel", "ok0", "etag0")
+            etags.set("testmodel", "ok0", "etag1")
+            etags.set("testmodel", "ok1", "etag2")
+            ETag.select().count().should.be.equal(2)
+
+            etags.clear()
+            etags.load("testmodel", ["ok0", "ok1", "ok2"])
+            dict(etags.cache).should.be.equal({("testmodel", "ok0"): "etag1",
+                                               ("testmodel", "ok1"): "etag2",
+                                               ("testmodel", "ok2"): None})
+            etags.delete("testmodel", "ok0")
+            etags.get("testmodel", "ok0").should.be.none
+            ETag.select().count().should.be.equal(1)
+
+        # The cache is not shared between databases
+        with test_database(self.dbs[1], self.models, create_tables=False):
+            self._createTables()
+            etags.get("testmodel", "ok1").should.be.none
+
+    def testSyncEngine(self):
+        """ Sync several models concurrently. """
+        models = (TestModel, TestNote, History, KeyValue, ETag, SeenHistory, Lease)
+        dbs = [SyncDatabase(None) for i in range(2)]
+        for database in dbs:
+            database.init(":memory:", threadlocals=False, check_same_thread=False)
+        conns = []
+        thread = threading.Thread(target=lambda: conns.append(dbs[0].get_conn()))
+        thread.start()
+        thread.join()
+        conns.should.be.equal([dbs[0].get_conn()])
+        # HTTPretty is not thread safe
+        engine = SyncEngine([TestModel, TestNote], concurrency=1)
+        with test_database(dbs[0], models, create_tables=False):
+            for m in models:
+                m.create_table()
+            for item in self.items:
+                TestModel.create(**item)
+                TestNote.create(uuid=item["key"], content=item["content"])
+            stats = engine.sync()
+            stats.pushed.should.be.equal(2 * NB_ITEMS)
+            stats.errors.should.be.empty
+
+        with test_database(dbs[1], models, create_tables=False):
+            for m in models:
+                m.create_table()
+            stats = engine.sync()
+            stats.pulled.should.be.equal(2 * NB_ITEMS)
+            self._rawEntries(TestModel._select()).should.be.equal(self.items)
+            TestNote._select().count().should.be.equal(NB_ITEMS)
+
+    def testSyncWorker(self):
+        """ Auto sync is performed in the background. """
+        db = peewee.SqliteDatabase(":memory:", threadlocals=False, check_same_thread=False)
+        worker = SyncWorker([TestModel], interval=None, debounce=60)
+        TestModel.Sync.auto = True
+        TestModel.Sync.worker = worker
+        worker.start()
+        try:
+            with test_database(db, self.models, create_tables=False):
+                self._createTables()
+                HTTPretty.latest_requests = []
+                for item in self.items:
+                    TestModel.create(**item)
+                TestModel.select().count().should.be.equal(NB_ITEMS)
+                # Nothing is synced until the debounce delay expires
+                HTTPretty.latest_requests.should.be.empty
+                worker.pending.should.be.equal(set([TestModel]))
+
+                worker.flush(10).should.be.true
+                worker.last_stats.pushed.should.be.equal(NB_ITEMS)
+        finally:
+            worker.stop(flush=False)
+
+        _items = requests.get("http://localhost/api/testmodel/").json().get("_items", [])
+        self._rawEntries(_items).should.be.equal(self.items)
+
+    def testPaginatedPull(self):
+        """ Remote history is pulled page by page, and the pull can be resumed. """
+        history = []
+        for i, item in enumerate(self.items[:4]):
+            history.append({"ts": 10 + i / 2, "uuid": "uuid{0}".format(i), "model": "testmodel",
+                            "action": "create", "pk": item["key"], "data": json.dumps(item)})
+        fail_on_request = []
+        wheres = []
+
+        def app(request):
+            url = urlparse.urlparse(request.url)
+            if url.path == "/api/history/":
+                params = urlparse.parse_qs(url.query)
+                wheres.append(json.loads(params["where"][0]))
+                if len(wheres) in fail_on_request:
+                    return 500, {}, "{}"
+                max_results = int(params["max_results"][0])
+                docs = sorted([h for h in history if match(h, wheres[-1])], key=remote.history_key)
+                resp = {"_items": docs[:max_results], "_links": {}}
+                if len(docs) > max_results:
+                    resp["_links"]["next"] = {"href": "history/?page=2"}
+                return 200, {}, json.dumps(resp)
+            pks = json.loads(urlparse.parse_qs(url.query)["where"][0])["key"]["$in"]
+            items = [dict(json.loads(h["data"]), etag="etag" + h["pk"]) for h in history if h["pk"] in pks]
+            return 200, {}, json.dumps({"_items": items})
+
+        TestModel.Sync.transport = LocalTransport(app)
+        TestModel.Sync.page_size = 2
+        with test_database(self.dbs[0], self.models, create_tables=False):
+            self._createTables()
+            TestModel.sync_pull().should.be.equal(4)
+            TestModel.get_pull_cursor().should.be.equal({"ts": 11, "seq": 0, "uuid": "uuid3"})
+            self._rawEntries(TestModel._select()).should.be.equal(self.items[:4])
+            # The next pages start right after the last entry received
+            wheres[1].should.be.equal(remote.history_after("testmodel", (10, 0, "uuid1")))
+
+        del wheres[:]
+        fail_on_request.append(2)
+        with test_database(self.dbs[1], self.models, create_tables=False):
+            self._createTables()
+            TestModel.sync_pull.when.called_with().should.throw(requests.HTTPError)
+            TestModel.get_pull_cursor().should.be.equal({"ts": 10, "seq": 0, "uuid": "uuid1"})
+            del fail_on_request[:]
+            del wheres[:]
+            TestModel.sync_pull().should.be.equal(2)
+            # Resumed a few seconds before the cursor, the entries already pulled being skipped
+            wheres[0].should.be.equal({"ts": {"$gte": 10 - SYNC_BUFFER}, "model": "testmodel"})
+            self._rawEntries(TestModel._select()).should.be.equal(self.items[:4])
+
+            # An entry stamped before the cursor, but posted after the pull, is pulled by the next one
+            history.append({"ts": 11, "uuid": "uuid10", "model": "testmodel",
+                            "action": "create", "pk": self.items[4]["key"], "data": json.dumps(self.items[4])})
+            TestModel.sync_pull().should.be.equal(1)
+            self._rawEntries(TestModel._select()).should.be.equal(self.items[:5])
+            TestModel.get_pull_cursor().should.be.equal({"ts": 11, "seq": 0, "uuid": "uuid3"})
+
+    def testHybridClock(self):
+        """ History entries are ordered by (ts, seq), after the remote entries received. """
+        wall = [100]
+        hlc = HybridClock(lambda: wall[0])
+        hlc.now().should.be.equal((100, 0))
+        hlc.now().should.be.equal((100, 1))
+        # The wall clock goes back
+        wall[0] = 90
+        hlc.now().should.be.equal((100, 2))
+        hlc.update(200, 5)
+        hlc.now().should.be.equal((200, 6))
+        wall[0] = 300
+        hlc.now().should.be.equal((300, 0))
+
+        # Remote entries from a client whose clock is ahead
+        future = get_ts() + 3600
+        api = LocalApi(pk_maps={"testmodel": "key"})
+        api.resources["history"]["uuid0"] = {"uuid": "uuid0", "ts": future, "seq": 3, "model": "testmodel",
+                                             "action": "create", "pk": "ok0", "data": self.items[0]}
+        api.resources["testmodel"]["ok0"] = dict(self.items[0], etag="etag0")
+        TestModel.Sync.transport = LocalTransport(api)
+        with test_database(self.dbs[0], self.models, create_tables=False):
+            self._createTables()
+            TestModel.sync_pull().should.be.equal(1)
+            TestModel.create(**self.items[1])
+            TestModel.create(**self.items[2])
+            [(h.ts, h.seq) for h in History.pending("testmodel")].should.be.equal([(future, 4), (future, 5)])
+            TestModel.sync_push().should.be.equal(2)
+            # Written by another process sharing the database, whose clock is behind
+            TestModel._create(**self.items[3])
+            History.create(data=self.items[3], ts=get_ts(), action="create", model="testmodel", pk="ok3")
+            TestModel.sync_push().should.be.equal(1)
+        [(h["ts"], h["seq"]) for h in api.resources["history"].values()].should.be.equal(
+            [(future, 3), (future, 6), (future, 7), (future, 8)])
+
+    def testPullTransaction(self):
+        """ Each pulled page is applied locally in a single transaction. """
+        history = [{"ts": 10, "uuid": "uuid{0}".format(i), "model": "testmodel",
+                    "action": "create", "pk": item["key"], "data": json.dumps(item)}
+                   for i, item in enumerate(self.items[:3])]
+        history.append({"ts": 11, "uuid": "uuid3", "model": "testmodel",
+                        "action": "delete", "pk": self.items[1]["key"], "data": "{}"})
+
+        def app(request):
+            url = urlparse.urlparse(request.url)
+            if url.path == "/api/history/":
+                return 200, {}, json.dumps({"_items": history, "_links": {}})
+            pks = json.loads(urlparse.parse_qs(url.query)["where"][0])["key"]["$in"]
+            items = [dict(item, etag="etag" + item["key"]) for item in self.items if item["key"] in pks]
+            return 200, {}, json.dumps({"_items": items})
+
+        TestModel.Sync.transport = LocalTransport(app)
+        with test_database(self.dbs[0], self.models, create_tables=False):
+            self._createTables()
+            set_many = etags.set_many
+            etags.set_many = lambda *args: 1 / 0
+            try:
+                TestModel.sync_pull.when.called_with().should.throw(ZeroDivisionError)
+            finally:
+                etags.set_many = set_many
+            TestModel._select().count().should.be.equal(0)
+            TestModel.get_pull_cursor().should.be.equal({"ts": 0, "seq": 0, "uuid": ""})
+
+            TestModel.sync_pull().should.be.equal(4)
+            self._rawEntries(TestModel._select()).should.be.equal([self.items[0], self.items[2]])
+            get_etag("testmodel", self.items[0]["key"]).should.be.equal("etag" + self.items[0]["key"])
+            get_etag("testmodel", self.items[1]["key"]).should.be.none
+
+    def testPendingUpdates(self):
+        """ Local updates not pushed yet are kept over the pulled ones. """
+        for i in range(2):
+            with test_database(self.dbs[i], self.models, create_tables=False):
+                self._createTables()
+                if i == 0:
+                    TestModel.create(**self.items[0])
+                TestModel.sync()
+
+        for i in range(2):
+            with test_database(self.dbs[i], self.models, create_tables=False):
+                cmodel = TestModel._get(TestModel.key == "ok0")
+                cmodel.content = "content from {0}".format(i)
+                cmodel.save()
+                if i == 0:
+                    TestModel.sync()
+        with test_database(self.dbs[1], self.models, create_tables=False):
+            TestModel.sync_pull()
+            self._rawEntries(TestModel._select()).should.be.equal([{"key": "ok0", "content": "content from 1"}])
+            TestModel.sync()
+        with test_database(self.dbs[0], self.models, create_tables=False):
+            TestModel.sync()
+            self._rawEntries(TestModel._select()).should.be.equal([{"key": "ok0", "content": "content from 1"}])
+
+    def testFieldDiffs(self):
+        """ Updates only track and push the modified fields. """
+        with test_database(self.dbs[0], self.models, create_tables=False):
+            self._createTables()
+            TestModel.create(**self.items[0])
+            TestModel.sync()
+        with test_database(self.dbs[1], self.models, create_tables=False):
+            self._createTables()
+            TestModel.sync_pull()
+
+        with test_database(self.dbs[0], self.models, create_tables=False):
+            cmodel = TestModel._get(TestModel.key == "ok0")
+            cmodel.save()
+            History.pending("testmodel").count().should.be.equal(0)
+            cmodel.content = "new content0"
+            cmodel.save()
+            [h.data for h in History.pending("testmodel")].should.be.equal(
+                [{"content": "new content0"}])
+            HTTPretty.latest_requests = []
+            TestModel.sync_push()
+            patch = self._requests("PATCH", "/api/testmodel/")[0]
+            json.loads(urlparse.parse_qs(patch.body)["data"][0]).should.be.equal({"content": "new content0"})
+
+        with test_database(self.dbs[1], self.models, create_tables=False):
+            TestModel.sync_pull()
+            self._rawEntries(TestModel._select()).should.be.equal([{"key": "ok0", "content": "new content0"}])
+
+        # With only, the other modified fields are neither saved nor recorded
+        with test_database(self.dbs[2], (TestNote, History)):
+            note = TestNote.create(uuid="note0", content="c0", name="n0")
+            note.content = "c1"
+            note.name = "n1"
+            note.save(only=[TestNote.content])
+            History.select().order_by(History.id.desc()).get().data.should.be.equal({"content": "c1"})
+            note.dirty_fields.should.be.equal([TestNote.name])
+            TestNote._get(TestNote.uuid == "note0").name.should.be.equal("n0")
+            note.save()
+            History.select().order_by(History.id.desc()).get().data.should.be.equal({"name": "n1"})
+
+    def testPullUpdates(self):
+        """ Updates of different fields by several clients are all pulled. """
+        models = (TestNote, History, KeyValue, ETag, SeenHistory, Lease)
+        for idb in range(NB_CLIENTS):
+            with test_database(self.dbs[idb], models, create_tables=False):
+                for m in models:
+                    m.create_table()
+                if idb == 0:
+                    TestNote.create(uuid="note0", content="c0", name="n0")
+                TestNote.sync()
+
+        for idb, field, value in [(0, "content", "c1"), (1, "name", "n1")]:
+            with test_database(self.dbs[idb], models, create_tables=False):
+                TestNote.sync_pull()
+                note = TestNote._get(TestNote.uuid == "note0")
+                setattr(note, field, value)
+                note.save()
+                TestNote.sync_push().should.be.equal(1)
+
+        with test_database(self.dbs[2], models, create_tables=False):
+            TestNote.sync_pull().should.be.equal(2)
+            note = TestNote._get(TestNote.uuid == "note0")
+            (note.content, note.name).should.be.equal(("c1", "n1"))
+
+    def testUnmodifiedSave(self):
+        """ Saving an unmodified model doesn't perform any query. """
+        database = InstrumentedSqliteDatabase(":memory:")
+        with test_database(database, self.models, create_tables=False):
+            self._createTables()
+            TestModel.create(**self.items[0])
+            cmodel = TestModel._get(TestModel.key == "ok0")
+            metrics.reset()
+            cmodel.save().should.be.equal(0)
+            metrics.snapshot()["counters"].get("sql.queries", 0).should.be.equal(0)
+            cmodel.content = "new content0"
+            cmodel.save().should.be.equal(1)
+            History.select().count().should.be.equal(2)
+
+    def testBulkQueries(self):
+        """ Bulk update/delete/insert/insert_many record History for each row and are pushed. """
+        with test_database(self.dbs[0], self.models, create_tables=False):
+            self._createTables()
+            TestModel.insert_many(self.items[:4]).execute()
+            TestModel.update(content="bulk").where(TestModel.key << ["ok0", "ok1"]).execute()
+            TestModel.delete().where(TestModel.key == "ok10").execute().should.be.equal(1)
+            TestModel.insert(key="ok12", content="content12").execute()
+            TestModel.update({TestModel.content: "dict"}).where(TestModel.key == "ok12").execute()
+            [(h.action, h.pk) for h in History.pending("testmodel")].should.be.equal(
+                [("create", "ok0"), ("create", "ok1"), ("create", "ok10"), ("create", "ok11"),
+                 ("update", "ok0"), ("update", "ok1"), ("delete", "ok10"),
+                 ("create", "ok12"), ("update", "ok12")])
+            TestModel.sync_push()
+
+        expected = [{"key": "ok0", "content": "bulk"}, {"key": "ok1", "content": "bulk"}, self.items[3],
+                    {"key": "ok12", "content": "dict"}]
+        _items = requests.get("http://localhost/api/testmodel/").json().get("_items", [])
+        self._rawEntries(_items).should.be.equal(expected)
+
+        # The field defaults are recorded in the History, the same as inserted
+        with test_database(self.dbs[1], (TestNote, History)):
+            TestNote.insert_many([{"content": "a"}, {TestNote.content: "b"}]).execute()
+            [(h.pk, h.data) for h in History.select().order_by(History.id)].should.be.equal(
+                [(n.uuid, {"uuid": n.uuid, "content": n.content, "name": ""})
+                 for n in TestNote._select().order_by(TestNote.id)])
+
+    def testFilteredSync(self):
+        """ Only the models matching the filter are pushed and pulled. """
+        with test_database(self.dbs[0], self.models, create_tables=False):
+            self._createTables()
+            for key, content in [("ok0", "a"), ("ok1", "b"), ("ok10", "a")]:
+                TestModel.create(key=key, content=content)
+            TestModel.sync()
+
+        TestModel.Sync.filter = (TestModel.content == "a", {"content": "a"})
+        with test_database(self.dbs[1], self.models, create_tables=False):
+            self._createTables()
+            TestModel.sync_pull()
+            sorted(m.key for m in TestModel._select()).should.be.equal(["ok0", "ok10"])
+            TestModel.create(key="ok11", content="a")
+            TestModel.create(key="ok12", content="b")
+            TestModel.sync_push().should.be.equal(1)
+            [h.pk for h in History.pending("testmodel")].should.be.equal(["ok12"])
+            KeyValue.get_key('last_dev_eve_sync_pull:testmodel:{"content": "a"}').should.be.a(dict)
+
+        TestModel.Sync.filter = None
+        with test_database(self.dbs[0], self.models, create_tables=False):
+            TestModel.update(content="a").where(TestModel.key == "ok1").execute()
+            TestModel.update(content="b").where(TestModel.key == "ok0").execute()
+            TestModel.sync()
+
+        TestModel.Sync.filter = (TestModel.content == "a", {"content": "a"})
+        with test_database(self.dbs[1], self.models, create_tables=False):
+            TestModel.sync_pull()
+            sorted(m.key for m in TestModel._select()).should.be.equal(["ok1", "ok10", "ok11", "ok12"])
+
+            # A model updated out of the filter is still pushed
+            cmodel = TestModel._get(TestModel.key == "ok10")
+            cmodel.content = "b"
+            cmodel.save()
+            TestModel.sync_push().should.be.equal(1)
+            [h.pk for h in History.pending("testmodel")].should.be.equal(["ok12"])
+
+            # A model entering the filter is pushed along with its pending create
+            cmodel = TestModel._get(TestModel.key == "ok12")
+            cmodel.content = "a"
+            cmodel.save()
+            TestModel.sync_push().should.be.equal(1)
+            History.pending("testmodel").count().should.be.equal(0)
+        requests.get("http://localhost/api/testmodel/ok10/").json()["content"].should.be.equal("b")
+        requests.get("http://localhost/api/testmodel/ok12/").json()["content"].should.be.equal("a")
+
+    def testPushRetry(self):
+        """ Failed History entries are retried with a backoff. """
+        calls = []
+        api_down = [True]
+
+        def app(request):
+            calls.append((request.method, request.url))
+            if api_down[0]:
+                return 500, {}, "{}"
+            item = {"status": "OK", "etag": "etag0"}
+            return 200, {}, json.dumps({"item": item, "item0": item})
+
+        TestModel.Sync.transport = LocalTransport(app, breaker=CircuitBreaker(threshold=100))
+        TestModel.Sync.optimistic_create = True
+        with test_database(self.dbs[0], self.models, create_tables=False):
+            self._createTables()
+            TestModel.create(**self.items[0])
+            TestModel.create(**self.items[1])
+            TestModel.sync_push().should.be.equal(0)
+            [(h.attempts, h.retry_at > get_ts()) for h in History.pending("testmodel")].should.be.equal(
+                [(1, True), (1, True)])
+
+            # Entries are not retried before their retry_at
+            del calls[:]
+            TestModel.sync_push().should.be.equal(0)
+            calls.should.be.empty
+
+            api_down[0] = False
+            History.update(retry_at=0).execute()
+            TestModel.sync_push().should.be.equal(2)
+            History.pending("testmodel").count().should.be.equal(0)
+
+    def testPushHistoryFailure(self):
+        """ Entries whose History failed to be posted are kept pending, only their History is retried. """
+        api = LocalApi(pk_maps={"testmodel": "key"})
+        calls = []
+        history_down = [True]
+
+        def app(request):
+            calls.append((request.method, urlparse.urlparse(request.url).path))
+            if request.method == "POST" and "/history/" in request.url and history_down[0]:
+                return 500, {}, "{}"
+            return api(request)
+        TestModel.Sync.transport = LocalTransport(app, breaker=CircuitBreaker(threshold=100))
+        TestModel.Sync.batch_size = 5
+        with test_database(self.dbs[0], self.models, create_tables=False):
+            self._createTables()
+            for item in self.items[:5]:
+                TestModel.create(**item)
+            TestModel.sync_push().should.be.equal(0)
+            len(api.resources["testmodel"]).should.be.equal(5)
+            [h.is_applied for h in History.pending("testmodel")].should.be.equal([True] * 5)
+
+            history_down[0] = False
+            History.update(retry_at=0).execute()
+            del calls[:]
+            TestModel.sync_push().should.be.equal(5)
+            calls.should.be.equal([("POST", "/api/history/")])
+            History.pending("testmodel").count().should.be.equal(0)
+
+            # The History is also posted again when the resource is known to exist
+            TestModel.Sync.batch_size = 1
+            history_down[0] = True
+            TestModel.create(**self.items[5])
+            TestModel.sync_push().should.be.equal(0)
+            # As if the push was interrupted before recording it
+            History.update(is_applied=False).execute()
+            history_down[0] = False
+            History.update(retry_at=0).execute()
+            del calls[:]
+            TestModel.sync_push().should.be.equal(1)
+            calls.should.be.equal([("POST", "/api/history/")])
+            len(api.resources["history"]).should.be.equal(6)
+
+        with test_database(self.dbs[1], self.models, create_tables=False):
+            self._createTables()
+            TestModel.sync_pull().should.be.equal(6)
+            self._rawEntries(TestModel._select()).should.be.equal(self.items[:6])
+
+    def testPushLease(self):
+        """ A single process pushes a model at a time, expired leases are taken over. """
+        api = LocalApi(pk_maps={"testmodel": "key"}, latency=0.01)
+        TestModel.Sync.transport = LocalTransport(api)
+        TestModel.Sync.optimistic_create = True
+        db = peewee.SqliteDatabase(":memory:", threadlocals=False, check_same_thread=False)
+        with test_database(db, self.models, create_tables=False):
+            self._createTables()
+            TestModel.insert_many(self.items).execute()
+
+            # Held by a live process
+            Lease.create(name="push:testmodel", owner="other", expires_at=get_ts() + 60)
+            TestModel.sync_push().should.be.equal(0)
+            api.stats["calls"].should.be.empty
+
+            # Concurrent pushes, only one of them pushes the History
+            Lease.update(expires_at=get_ts() - 1).execute()
+            results = []
+            threads = [threading.Thread(target=lambda: results.append(TestModel.sync_push())) for i in range(2)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            sorted(results).should.be.equal([0, NB_ITEMS])
+            len(api.resources["history"]).should.be.equal(NB_ITEMS)
+            api.stats["calls"]["POST"].should.be.equal(2 * NB_ITEMS)
+            Lease.select().count().should.be.equal(0)
+
+            # The lease is lost during the push, the new owner pushes the remaining entries
+            def app(request):
+                if request.method == "PATCH":
+                    Lease.update(owner="other", expires_at=get_ts() + 60).execute()
+                return api(request)
+
+            TestModel.Sync.transport = LocalTransport(app)
+            TestModel.Sync.lease_ttl = 0
+            TestModel.update(content="updated").execute()
+            TestModel.sync_push().should.be.equal(1)
+            History.pending("testmodel").count().should.be.equal(NB_ITEMS - 1)
+            TestModel.Sync.transport = LocalTransport(api)
+            Lease.update(expires_at=get_ts() - 1).execute()
+            TestModel.sync_push().should.be.equal(NB_ITEMS - 1)
+
+    def testCircuitBreaker(self):
+        """ The API isn't called anymore after several consecutive failures. """
+        calls = []
+
+        def app(request):
+            calls.append(request.url)
+            return 503, {}, "{}"
+
+        breaker = CircuitBreaker(threshold=2, reset_timeout=0.1)
+        transport = LocalTransport(app, breaker=breaker)
+        transport.get(transport.root("testmodel"))
+        transport.get(transport.root("testmodel"))
+        breaker.is_open.should.be.true
+        transport.get.when.called_with(transport.root("testmodel")).should.throw(CircuitOpen)
+        len(calls).should.be.equal(2)
+
+        time.sleep(0.1)
+        transport.get(transport.root("testmodel")).status_code.should.be.equal(503)
+        len(calls).should.be.equal(3)
+        transport.get.when.called_with(transport.root("testmodel")).should.throw(CircuitOpen)
+
+    def testLocalApi(self):
+        """ Models are synced between clients through the in-process Eve stand-in. """
+        api = LocalApi(pk_maps={"testmodel": "key"})
+        TestModel.Sync.transport = LocalTransport(api)
+        TestModel.Sync.batch_size = 5
+        with test_database(self.dbs[0], self.models, create_tables=False):
+            self._createTables()
+            TestModel.insert_many(self.items).execute()
+            TestModel.sync()
+        api.stats["calls"]["POST"].should.be.equal(2 * NB_ITEMS / 5)
+
+        with test_database(self.dbs[1], self.models, create_tables=False):
+            self._createTables()
+            TestModel.sync()
+            self._rawEntries(TestModel._select()).should.be.equal(self.items)
+            cmodel = TestModel._get(TestModel.key == "ok0")
+            cmodel.content = "new content0"
+            cmodel.save()
+            TestModel.sync()
+        api.resources["testmodel"]["ok0"]["content"].should.be.equal("new content0")
+
+        # Outdated ETag
+        remote.patch_resource.when.called_with("testmodel", "ok0", json.dumps({"content": "x"}), "etag",
+                                               transport=TestModel.Sync.transport).should.throw(requests.HTTPError)
+        api.stats["status"][412].should.be.equal(1)
+
+    def testWireFormat(self):
+        """ Request bodies can be sent as gzipped JSON. """
+        api = LocalApi(pk_maps={"testmodel": "key"})
+        requests_headers = []
+
+        def app(request):
+            requests_headers.append(dict(request.headers))
+            return api(request)
+        TestModel.Sync.transport = LocalTransport(app, body_encoding="json", compress=True, compress_min_size=0)
+        with test_database(self.dbs[0], self.models, create_tables=False):
+            self._createTables()
+            TestModel.insert_many(self.items).execute()
+            TestModel.sync()
+            cmodel = TestModel._get(TestModel.key == "ok0")
+            cmodel.content = u"new contenté"
+            cmodel.save()
+            TestModel.sync()
+        posts = [h for h in requests_headers if h.get("Content-Type") == "application/json"]
+        posts.should_not.be.empty
+        all(h.get("Content-Encoding") == "gzip" for h in posts).should.be.ok
+        api.resources["testmodel"]["ok0"]["content"].should.be.equal(u"new contenté")
+
+        with test_database(self.dbs[1], self.models, create_tables=False):
+            self._createTables()
+            TestModel.sync()
+            TestModel._get(TestModel.key == "ok0").content.should.be.equal(u"new contenté")
+            TestModel._select().count().should.be.equal(NB_ITEMS)
+
+    @unittest.skipIf(encoding.msgpack is None, "msgpack is not installed")
+    def testMsgpackWireFormat(self):
+        """ Request and response bodies can be encoded with msgpack. """
+        encoding.unpack(encoding.pack({u"content": u"é", u"n": [1, 2]}, encoding.MSGPACK),
+                        encoding.MSGPACK).should.be.equal({u"content": u"é", u"n": [1, 2]})
+        api = LocalApi(pk_maps={"testmodel": "key"})
+        content_types = []
+
+        def app(request):
+            status, headers, body = api(request)
+            content_types.append(headers.get("Content-Type"))
+            return status, headers, body
+        TestModel.Sync.transport = LocalTransport(app, body_encoding="msgpack")
+        with test_database(self.dbs[0], self.models, create_tables=False):
+            self._createTables()
+            TestModel.insert_many(self.items).execute()
+            TestModel.sync()
+        content_types.should.contain(encoding.MSGPACK)
+
+        with test_database(self.dbs[1], self.models, create_tables=False):
+            self._createTables()
+            TestModel.sync()
+            self._rawEntries(TestModel._select()).should.be.equal(self.items)
+
+    def testSeenHistory(self):
+        """ History entries pushed or pulled by this client are skipped when pulled. """
+        api = LocalApi(pk_maps={"testmodel": "key"})
+        TestModel.Sync.transport = LocalTransport(api)
+        TestModel.Sync.batch_size = 5
+        with test_database(self.dbs[0], self.models, create_tables=False):
+            self._createTables()
+            TestModel.insert_many(self.items).execute()
+            cmodel = TestModel._get(TestModel.key == "ok0")
+            cmodel.content = "new content0"
+            cmodel.save()
+            # The update is folded into the create
+            TestModel.sync_push().should.be.equal(NB_ITEMS)
+            SeenHistory.select().count().should.be.equal(NB_ITEMS)
+            api.reset_stats()
+            TestModel.sync_pull().should.be.equal(0)
+            # Only the History page is fetched
+            api.round_trips.should.be.equal(1)
+
+        with test_database(self.dbs[1], self.models, create_tables=False):
+            self._createTables()
+            TestModel.sync_pull().should.be.equal(NB_ITEMS)
+            TestModel.set_cursor("pull", 0)
+            TestModel.sync_pull().should.be.equal(0)
+            self._rawEntries(TestModel._select()).should.be.equal(
+                [dict(self.items[0], content="new content0")] + self.items[1:])
+
+        # The bloom filter is rebuilt from the table of each database
+        with test_database(self.dbs[0], self.models, create_tables=False):
+            uuids = [h.uuid for h in History.select()]
+            seen_history.seen(uuids + ["unknown"]).should.be.equal(set(uuids))
+
+    def testBootstrap(self):
+        """ A fresh client downloads a snapshot instead of replaying the remote History. """
+        api = LocalApi(pk_maps={"testmodel": "key"})
+        TestModel.Sync.transport = LocalTransport(api)
+        TestModel.Sync.batch_size = 5
+        with test_database(self.dbs[0], self.models, create_tables=False):
+            self._createTables()
+            TestModel.insert_many(self.items).execute()
+            TestModel.sync()
+            cmodel = TestModel._get(TestModel.key == "ok0")
+            cmodel.content = "new content0"
+            cmodel.save()
+            TestModel._get(TestModel.key == "ok1").delete_instance()
+            TestModel.sync()
+        last_ts = max(h["ts"] for h in api.resources["history"].values())
+
+        TestModel.Sync.bootstrap = True
+        TestModel.Sync.bootstrap_page_size = 7
+        try:
+            with test_database(self.dbs[1], self.models, create_tables=False):
+                self._createTables()
+                api.reset_stats()
+                metrics.reset()
+                TestModel.sync_pull()
+                metrics.counters["bootstrap.items"].should.be.equal(NB_ITEMS - 1)
+                # The latest History entry, 3 pages of resources, then the History
+                # since the snapshot, with the updated resources
+                api.stats["calls"]["GET"].should.be.equal(6)
+                TestModel.get_pull_cursor()["ts"].should.be.equal(last_ts)
+                self._rawEntries(TestModel._select()).should.be.equal(
+                    [dict(self.items[0], content="new content0")] + self.items[2:])
+                get_etag("testmodel", "ok2").should.be.equal(api.resources["testmodel"]["ok2"]["etag"])
+
+            # Incremental pull takes over
+            with test_database(self.dbs[0], self.models, create_tables=False):
+                cmodel = TestModel._get(TestModel.key == "ok2")
+                cmodel.content = "new content2"
+                cmodel.save()
+                TestModel.sync()
+            with test_database(self.dbs[1], self.models, create_tables=False):
+                TestModel.sync_pull().should.be.equal(1)
+                TestModel._get(TestModel.key == "ok2").content.should.be.equal("new content2")
+        finally:
+            TestModel.Sync.bootstrap = False
+
+    def testReconcile(self):
+        """ Models diverging from the API are found by comparing hash trees, and repaired. """
+        api = LocalApi(pk_maps={"testmodel": "key"})
+        merkle_supported = [True]
+        failing = []
+
+        def app(request):
+            if "/_merkle/" in request.url and not merkle_supported[0]:
+                return 404, {}, "{}"
+            if any(pk in request.url for pk in failing):
+                return 500, {}, "{}"
+            return api(request)
+        TestModel.Sync.transport = LocalTransport(app)
+        TestModel.Sync.batch_size = 5
+        with test_database(self.dbs[0], self.models, create_tables=False):
+            self._createTables()
+            TestModel.insert_many(self.items).execute()
+            TestModel.sync()
+
+        with test_database(self.dbs[1], self.models, create_tables=False):
+            self._createTables()
+            TestModel.sync()
+            api.reset_stats()
+            TestModel.sync_reconcile().should.be.equal(0)
+            api.round_trips.should.be.equal(1)
+
+            # Changes missed by the client
+            api.resources["testmodel"]["ok3"].update(content="new content3", etag="etag3")
+            del api.resources["testmodel"]["ok4"]
+            api.resources["testmodel"]["ok99"] = {"key": "ok99", "content": "content99", "etag": "etag99"}
+            api.reset_stats()
+            TestModel.sync_reconcile().should.be.equal(3)
+            # A few hash requests, and a single GET of the resources
+            api.round_trips.should.be.lower_than(10)
+            expected = sorted(api.resources["testmodel"].values(), key=lambda doc: doc["key"])
+            self._rawEntries(TestModel._select()).should.be.equal(
+                [{"key": doc["key"], "content": doc["content"]} for doc in expected])
+            get_etag("testmodel", "ok3").should.be.equal("etag3")
+            get_etag("testmodel", "ok4").should.be.none
+
+            # Without hash trees on the API, the ETags of the whole collection are fetched
+            merkle_supported[0] = False
+            api.resources["testmodel"]["ok5"].update(content="new content5", etag="etag5")
+            TestModel.sync_reconcile().should.be.equal(1)
+            TestModel._get(TestModel.key == "ok5").content.should.be.equal("new content5")
+
+            # Resources are fetched by chunks, the models of a chunk which failed are left untouched
+            merkle_supported[0] = True
+            max_pks = sync_model.MAX_PKS_PER_QUERY
+            sync_model.MAX_PKS_PER_QUERY = 1
+            try:
+                for key in ("ok6", "ok7"):
+                    api.resources["testmodel"][key].update(content="new content", etag="new etag")
+                failing.append("ok7")
+                TestModel.sync_reconcile().should.be.equal(1)
+                TestModel._get(TestModel.key == "ok7").content.should.be.equal("content7")
+                del failing[:]
+                TestModel.sync_reconcile().should.be.equal(1)
+                TestModel._get(TestModel.key == "ok7").content.should.be.equal("new content")
+            finally:
+                sync_model.MAX_PKS_PER_QUERY = max_pks
+
+    def testSyncFeed(self):
+        """ Remote History entries are long-polled, and applied as soon as they are available. """
+        api = LocalApi(pk_maps={"testmodel": "key"})
+        fail = [0]
+
+        def app(request):
+            if fail[0]:
+                fail[0] -= 1
+                return 500, {}, "{}"
+            return api(request)
+        transport = LocalTransport(app, breaker=CircuitBreaker(threshold=100))
+        TestModel.Sync.transport = transport
+
+        def push(item, uuid):
+            # Another client, unaffected by the errors
+            remote.post_resource("testmodel", item["key"], item, optimistic=True, transport=LocalTransport(api),
+                                 raw_history={"uuid": uuid, "model": "testmodel", "action": "create",
+                                              "pk": item["key"], "data": item})
+
+        database = peewee.SqliteDatabase(":memory:", threadlocals=False, check_same_thread=False)
+        with test_database(database, self.models, create_tables=False):
+            self._createTables()
+            feed = SyncFeed([TestModel], wait=0.2)
+            start = time.time()
+            feed.poll().should.be.equal(0)
+            (time.time() - start).should.be.greater_than(0.15)
+
+            # Entry pushed by another client during the request
+            feed.wait = 5
+            threading.Timer(0.1, push, (self.items[0], "uuid0")).start()
+            start = time.time()
+            feed.poll().should.be.equal(1)
+            (time.time() - start).should.be.lower_than(2)
+            self._rawEntries(TestModel._select()).should.be.equal(self.items[:1])
+
+            # The feed resumes from the pull cursor, and reconnects after errors
+            fail[0] = 2
+            feed = SyncFeed([TestModel], wait=5, retry_delay=0.01)
+            feed.start()
+            try:
+                push(self.items[1], "uuid1")
+                for i in range(100):
+                    if TestModel._select().count() == 2:
+                        break
+                    time.sleep(0.02)
+            finally:
+                feed.stop(timeout=0)
+            self._rawEntries(TestModel._select()).should.be.equal(self.items[:2])
+
+    def testMetaDatabase(self):
+        """ Sync metadata can be stored in its own database, in WAL mode. """
+        tmpdir = tempfile.mkdtemp()
+        try:
+            database = SyncDatabase(os.path.join(tmpdir, "app.db"), pragmas=WAL_PRAGMAS)
+            meta_database = SyncDatabase(os.path.join(tmpdir, "sync.db"), pragmas=WAL_PRAGMAS)
+            api = LocalApi(pk_maps={"testmodel": "key"})
+            TestModel.Sync.transport = LocalTransport(api)
+            TestModel.Sync.batch_size = 5
+            with test_database(self.dbs[0], self.models, create_tables=False):
+                self._createTables()
+                TestModel.insert_many(self.items).execute()
+                TestModel.sync()
+
+            with test_database(database, self.models, create_tables=False):
+                for m in (TestModel, History):
+                    m.create_table()
+                init_meta_database(meta_database)
+                TestModel.sync()
+                self._rawEntries(TestModel._select()).should.be.equal(self.items)
+                database.get_tables().should.be.equal(["history", "testmodel"])
+                ETag.select().count().should.be.equal(NB_ITEMS)
+                TestModel.get_pull_cursor()["ts"].should.be.greater_than(0)
+                for d in (database, meta_database):
+                    d.execute_sql("PRAGMA journal_mode").fetchone()[0].should.be.equal("wal")
+                    d.execute_sql("PRAGMA synchronous").fetchone()[0].should.be.equal(1)
+
+                # A page is rolled back in both databases
+                set_cursor = TestModel.set_cursor
+                TestModel.set_cursor = classmethod(lambda *args: 1 / 0)
+                api.resources["history"]["uuid0"] = {"uuid": "uuid0", "ts": get_ts() + 10, "model": "testmodel",
+                                                     "action": "delete", "pk": "ok0", "data": {}}
+                try:
+                    TestModel.sync_pull.when.called_with().should.throw(ZeroDivisionError)
+                finally:
+                    TestModel.set_cursor = set_cursor
+                TestModel._select().count().should.be.equal(NB_ITEMS)
+
+                # The models matching a filter are selected apart from their ETags
+                TestModel.sync_reconcile(filter=(TestModel.key != "", {})).should.be.equal(0)
+            database.close()
+            meta_database.close()
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def testMetrics(self):
+        """ Sync counters and timings are recorded, and hooks are called. """
+        events = []
+        TestModel.Sync.transport = LocalTransport(LocalApi(pk_maps={"testmodel": "key"}))
+        TestModel.Sync.optimistic_create = True
+        metrics.reset()
+        metrics.add_hook(lambda *event: events.append(event))
+        database = InstrumentedSqliteDatabase(":memory:")
+        try:
+            with test_database(database, self.models, create_tables=False):
+                self._createTables()
+                TestModel.create(**self.items[0])
+                TestModel.create(**self.items[1])
+                TestModel.sync()
+        finally:
+            del metrics.hooks[:]
+
+        snapshot = metrics.snapshot()
+        counters = snapshot["counters"]
+        counters["push.items"].should.be.equal(2)
+        # Our own History entries are skipped when pulled
+        counters["pull.items"].should.be.equal(0)
+        # 2 creates and their History, then a single History page
+        counters["http.post"].should.be.equal(4)
+        counters["http.get"].should.be.equal(1)
+        counters["http.bytes_sent"].should.be.greater_than(0)
+        counters["sql.queries"].should.be.greater_than(0)
+        snapshot["histograms"]["sync.push"]["count"].should.be.equal(1)
+        snapshot["histograms"]["sync.pull"]["count"].should.be.equal(1)
+        events.should.contain(("counter", "push.items", 2))
+
+    def testLocalTransport(self):
+        """ Calls are served by an in-process app instead of the network. """
+        calls = []
+
+        def app(request):
+            calls.append((request.method, request.url))
+            return 200, {}, json.dumps({"key": "ok0", "content": "content0", "etag": "etag0"})
+
+        transport = LocalTransport(app, "http://example.com/api/")
+        remote.get_resource("testmodel", "ok0", transport=transport).should.be.equal(
+            {"key": "ok0", "content": "content0", "etag": "etag0"})
+        calls.should.be.equal([("GET", "http://example.com/api/testmodel/ok0/")])
+
+    def testMigrateSyncState(self):
+        """ Synced flags stored as KeyValue are moved to the History table. """
+        with test_database(self.dbs[0], self.models, create_tables=False):
+            self.dbs[0].execute_sql('CREATE TABLE "history" ("id" INTEGER NOT NULL PRIMARY KEY, '
+                                    '"data" VARCHAR(255) NOT NULL, "ts" INTEGER NOT NULL, '
+                                    '"action" VARCHAR(255) NOT NULL, "model" VARCHAR(255) NOT NULL, '
+                                    '"pk" VARCHAR(255) NOT NULL, "uuid" VARCHAR(255) NOT NULL)')
+            self._createTables()
+            for i, item in enumerate(self.items[:2]):
+                self.dbs[0].execute_sql('INSERT INTO "history" ("data", "ts", "action", "model", "pk", "uuid") '
+                                        'VALUES (?, ?, ?, ?, ?, ?)',
+                                        (json.dumps(json.dumps(item)), get_ts(), "create",
+                                         "testmodel", item["key"], "uuid{0}".format(i)))
+            KeyValue.set_key("history:uuid0", True)
+            KeyValue.set_key("etag:testmodel:ok0", "etag0")
+
+            migrate_sync_state()
+
+            [h.uuid for h in History.pending("testmodel")].should.be.equal(["uuid1"])
+            KeyValue.select().count().should.be.equal(0)
+            get_etag("testmodel", "ok0").should.be.equal("etag0")
+            History.mark_synced([History.get(History.uuid == "uuid1").id])
+            History.pending("testmodel").count().should.be.equal(0)
+
 if __name__ == '__main__':
     unittest.main()